@@ -1,6 +1,11 @@
 import torch
+from collections import namedtuple
 from megatron import mpu, print_rank_0
 
+# what the MoE pipeline hands to the loss: the lm output (hidden states, then logits) plus the per-layer
+# aux losses and routing metadata collected by MoEParallelTransformerLayerPipe
+MoEPipeOutput = namedtuple("MoEPipeOutput", ["output", "l_auxs", "metadata"])
+
 class MoEStateManager:
     """
     may cause oom, don't forget to call get_xxx
@@ -73,8 +78,14 @@ class MoECrossEnropy():
         self.fp16 = _fp16
 
     def forward(self, outputs, labels):
-        assert isinstance(outputs, (list, tuple)) and len(outputs) == 2
-        lm_outputs, moe_loss = outputs
+        if not isinstance(outputs, MoEPipeOutput) and len(outputs) == len(MoEPipeOutput._fields):
+            # activation checkpointing unpacks the pipeline args between layers, which drops the namedtuple
+            outputs = MoEPipeOutput(*outputs)
+        if isinstance(outputs, MoEPipeOutput):
+            lm_outputs, moe_loss = outputs.output, outputs.l_auxs
+        else:
+            assert isinstance(outputs, (list, tuple)) and len(outputs) == 2
+            lm_outputs, moe_loss = outputs
         lm_loss = cross_entropy(lm_outputs, labels, self.fp16)
         self.logging_loss.append(self.moe_loss_weight * sum(moe_loss).detach())
         return self.moe_loss_weight * sum(moe_loss) + lm_loss # lm_loss is averaged on batch, moe_loss is also computed at batch-level
@@ -85,4 +96,13 @@ class MoECrossEnropy():
             self.logging_loss = []
         else:
             res = 0.
-        return res
\ No newline at end of file
+        return res
+
+def get_criterion(moe, moe_loss_weight=0.01, _fp16=False):
+    """
+    Returns a new loss for a model with (moe=True) or without MoE layers. MoECrossEnropy keeps the losses it logs,
+    so every model gets its own instance.
+    """
+    if moe:
+        return MoECrossEnropy(moe_loss_weight=moe_loss_weight, _fp16=_fp16)
+    return CrossEntropy(_fp16=_fp16)
@@ -39,42 +39,59 @@ from megatron.model.transformer import (
 from megatron.model.moe_transformer import MoEParallelTransformerLayerPipe
 from megatron.model.gmlp import GMLPBlock
 from megatron.model.word_embeddings import EmbeddingPipe, SoftEmbedding
-from megatron.model.criterion import CrossEntropy, MoECrossEnropy
+from megatron.model.criterion import get_criterion, MoEPipeOutput
 # Pipeline parallelism
 from deepspeed.pipe import PipelineModule, LayerSpec, TiedLayerSpec
+from deepspeed.runtime import utils as ds_utils
 from typing import Union, List
 from megatron import print_rank, print_rank_0
 from functools import partial
 from megatron.model.moe.share_layer_moe import LayerAwareMoE
 
+# value used for masked attention scores, per attention score dtype
+_MASK_MIN = {
+    torch.float16: torch.finfo(torch.float16).min,
+    torch.bfloat16: torch.finfo(torch.bfloat16).min,
+    torch.float32: torch.finfo(torch.float32).min,
+}
+
+
 def gpt2_attention_mask_func(attention_scores, ltor_mask):
-    mask_value = torch.finfo(attention_scores.dtype).min
-    # Need to be a tensor, otherwise we get error: `RuntimeError: expected scalar type float but found double`.
-    # Need to be on the same device, otherwise `RuntimeError: ..., x and y to be on the same device`
-    mask_value = torch.tensor(mask_value, dtype=attention_scores.dtype, device=attention_scores.device)
+    # a Python scalar fill value needs no device tensor (and no host-to-device copy) per call
+    mask_value = _MASK_MIN.get(attention_scores.dtype)
+    if mask_value is None:
+        # other float dtypes, e.g. float64 on cpu
+        mask_value = torch.finfo(attention_scores.dtype).min
     attention_scores.masked_fill_(ltor_mask, mask_value)
     return attention_scores
 
+
+# layer classes eligible for activation checkpointing in the pipeline (DeepSpeed's PipelineModule only accepts a list)
+CHECKPOINTABLE_LAYERS = [
+    "GMLPBlock",
+    "ParallelTransformerLayerPipe",
+    "MoEParallelTransformerLayerPipe",
+]
+
+
 def _pre_transformer_block(args):
-    # data format change for hidden_states to avoid explicit tranposes : [b s h] --> [s b h]
+    # EmbeddingPipe already emits hidden_states as [s b h], so there is no transpose (and no copy) left to do here.
+    # Kept as a (no-op) layer so that pipeline layer indices, and hence checkpoint layouts, are unchanged.
     assert len(args) == 2, "Incorrect number of arguments to _pre_transformer_block"
-    fn = lambda _args: (_args[0].transpose(0, 1).contiguous(), *_args[1:])
-    return fn(args)
+    return args
 
 
 def _post_transformer_block(args):
     # from (hidden_states, attention_mask)
     # to (hidden_states.T)
     assert len(args) == 2, "Incorrect number of arguments to _post_transformer_block"
-    fn = lambda _args: (_args[0].transpose(0, 1).contiguous())
-    return fn(args)
+    return args[0].transpose(0, 1).contiguous()
 
 def _post_moe_transformer_block(args):
-    # from (hidden_states, attention_mask, l_auxs)
-    # to (hidden_states.T)
-    assert len(args) > 2, "Incorrect number of arguments to _post_moe_transformer_block"
-    fn = lambda _args: (_args[0].transpose(0, 1).contiguous())
-    return fn(args), *args[2:]
+    # from (hidden_states, attention_mask, l_auxs, metadata)
+    # to MoEPipeOutput(hidden_states.T, l_auxs, metadata)
+    assert len(args) == 4, "Incorrect number of arguments to _post_moe_transformer_block"
+    return MoEPipeOutput(args[0].transpose(0, 1).contiguous(), args[2], args[3])
 
 
 class GPT2ModelPipe(PipelineModule, torch.nn.Module):
@@ -111,10 +128,11 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
 
         self.specs = []
         self.init_specs()  # initializes the layer specs (basically a fancy nn.Sequential)
-        if neox_args.moe_freq>0:
-            self.criterion = MoECrossEnropy(moe_loss_weight=self.neox_args.moe_loss_weight, _fp16=self.neox_args.fp16_lm_cross_entropy)
-        else:
-            self.criterion = CrossEntropy(_fp16=self.neox_args.fp16_lm_cross_entropy)
+        self.criterion = get_criterion(
+            neox_args.moe_freq > 0,
+            moe_loss_weight=neox_args.moe_loss_weight,
+            _fp16=neox_args.fp16_lm_cross_entropy,
+        )
 
         super().__init__(
             layers=self.specs,
@@ -124,8 +142,9 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
             if self.neox_args.checkpoint_activations
             else 0,
             partition_method=neox_args.pipe_partition_method,
-            checkpointable_layers=["GMLPBlock", "ParallelTransformerLayerPipe"],
+            checkpointable_layers=CHECKPOINTABLE_LAYERS,
         )
+        self._modules_with_attr_cache = {}
 
     def insert_layers(
         self, layers: Union[nn.Module, nn.ModuleList, nn.Sequential, List], idx
@@ -133,6 +152,7 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         """
         inserts the layers in `layers` into the pipe model at `idx`.
         """
+        num_specs = len(self.specs)
         if isinstance(layers, nn.Module):
             self.specs.insert(idx, layers)
         elif any(
@@ -149,6 +169,10 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
                 f"layer passed into {self.__class__.__name__}.insert_layer() should be either an nn.Module, an nn.ModuleList, an nn.Sequential object, or a list of callables not a {type(layers)}"
             )
 
+        if len(self.specs) == num_specs:
+            # nothing was inserted, so the existing partitioning / forward funcs are still valid
+            return
+
         # re-initialize parent class
         super().__init__(
             layers=self.specs,
@@ -156,8 +180,9 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
             topology=self.__topology__,
             activation_checkpoint_interval=self.activation_checkpoint_interval,
             partition_method=self.neox_args.pipe_partition_method,
-            checkpointable_layers=["GMLPBlock", "ParallelTransformerLayerPipe"],
+            checkpointable_layers=CHECKPOINTABLE_LAYERS,
         )
+        self._modules_with_attr_cache = {}
 
     def init_specs(self):
 
@@ -204,6 +229,7 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         self.specs.append(_pre_transformer_block)
 
         # T5 RPE positional embedding
+        rpe_emb = None
         if self.neox_args.pos_emb == "rpe":
             hidden_size_per_attention_head = mpu.divide(
                 self.neox_args.hidden_size, self.neox_args.num_attention_heads
@@ -219,60 +245,7 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
             )
 
         # Transformer layers
-        for i in range(self.neox_args.num_layers):
-            layer_type = self.neox_args.attention_config[i]
-            if layer_type in ["gmlp", "amlp"]:
-                self.specs.append(
-                    LayerSpec(
-                        GMLPBlock,
-                        init_method=self.init_method,
-                        layer_number=i,
-                        output_layer_init_method=self.output_layer_init_method,
-                        neox_args=self.neox_args,
-                        mask_fn=gpt2_attention_mask_func,
-                    )
-                )
-            else:
-                if self.neox_args.moe_freq > 0 and i%self.neox_args.moe_freq==(self.neox_args.moe_freq-1):
-                    layer_cls = MoEParallelTransformerLayerPipe
-                else:
-                    layer_cls = ParallelTransformerLayerPipe
-                # TODO: implement shared moe layers
-                if self.neox_args.moe_share_layers is not None and layer_cls == MoEParallelTransformerLayerPipe:
-                    assert self.neox_args.pipe_parallel_size <= 1, "not support using pp and sharing moe layers together"
-                    group_size = self.neox_args.moe_share_layers.get('group_size', self.neox_args.num_layers)
-                    assert self.neox_args.num_layers % group_size == 0
-                    group_idx = i // group_size
-                    # only share params inside group
-                    self.specs.append(
-                        TiedLayerSpec(
-                            "moe"+'_group_'+str(group_idx),
-                            MoEParallelTransformerLayerPipe,
-                            neox_args=self.neox_args,
-                            attention_mask_func=gpt2_attention_mask_func,
-                            init_method=self.init_method,
-                            output_layer_init_method=self.output_layer_init_method,
-                            layer_number=i,
-                            rpe=rpe_emb if self.neox_args.pos_emb == "rpe" else None,
-                            rotary=self.neox_args.pos_emb == "rotary",
-                            use_cache=self.use_cache,
-                        )
-                    )
-
-                else:
-                    self.specs.append(
-                        LayerSpec(
-                            layer_cls,
-                            neox_args=self.neox_args,
-                            attention_mask_func=gpt2_attention_mask_func,
-                            init_method=self.init_method,
-                            output_layer_init_method=self.output_layer_init_method,
-                            layer_number=i,
-                            rpe=rpe_emb if self.neox_args.pos_emb == "rpe" else None,
-                            rotary=self.neox_args.pos_emb == "rotary",
-                            use_cache=self.use_cache,
-                        )
-                    )
+        self.specs.extend(self._build_layer_plan(rpe_emb))
 
         # used to drop attention mask + reshape hidden states
         if self.neox_args.moe_freq > 0:
@@ -288,14 +261,22 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
 
         # outputs are now a single tensor: hidden_states
 
-        def _logits_helper(embedding, lm_output):
-            """Just a wrapper to massage inputs/outputs from pipeline."""
-            if isinstance(lm_output, (list, tuple)):
+        # the output layout is fixed by the post transformer block, so pick the matching helper once here
+        # instead of type-checking lm_output on every call
+        if self.neox_args.moe_freq > 0:
+
+            def _logits_helper(embedding, lm_output):
+                """Just a wrapper to massage inputs/outputs from pipeline (MoEPipeOutput in, MoEPipeOutput out)."""
+                # activation checkpointing unpacks the pipeline args, so lm_output may be a plain tuple here
                 logits = parallel_lm_logits(
                     lm_output[0], embedding.word_embeddings_weight, self.parallel_output
                 )
-                return logits, *lm_output[1:]
-            else:
+                return MoEPipeOutput(logits, *lm_output[1:])
+
+        else:
+
+            def _logits_helper(embedding, lm_output):
+                """Just a wrapper to massage inputs/outputs from pipeline."""
                 return parallel_lm_logits(
                     lm_output, embedding.word_embeddings_weight, self.parallel_output
                 )
@@ -327,12 +308,131 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
                 )
             )
 
+    def _build_layer_plan(self, rpe_emb=None):
+        """
+        Returns the specs of the transformer layers, in order.
+        All config lookups that are the same for every layer are resolved once, up front.
+        """
+        neox_args = self.neox_args
+        num_layers = neox_args.num_layers
+        moe_freq = neox_args.moe_freq
+        moe_share_layers = neox_args.moe_share_layers
+
+        is_moe_layer = [
+            moe_freq > 0 and i % moe_freq == (moe_freq - 1) for i in range(num_layers)
+        ]
+        # TODO: implement shared moe layers
+        share_moe_layers = moe_share_layers is not None and any(is_moe_layer)
+        if share_moe_layers:
+            assert neox_args.pipe_parallel_size <= 1, "not support using pp and sharing moe layers together"
+            group_size = moe_share_layers.get("group_size", num_layers)
+            assert num_layers % group_size == 0
+
+        transformer_layer_kwargs = dict(
+            neox_args=neox_args,
+            attention_mask_func=gpt2_attention_mask_func,
+            init_method=self.init_method,
+            output_layer_init_method=self.output_layer_init_method,
+            rpe=rpe_emb,
+            rotary=neox_args.pos_emb == "rotary",
+            use_cache=self.use_cache,
+        )
+
+        layer_plan = []
+        for i in range(num_layers):
+            if neox_args.attention_config[i] in ["gmlp", "amlp"]:
+                layer_plan.append(
+                    LayerSpec(
+                        GMLPBlock,
+                        init_method=self.init_method,
+                        layer_number=i,
+                        output_layer_init_method=self.output_layer_init_method,
+                        neox_args=neox_args,
+                        mask_fn=gpt2_attention_mask_func,
+                    )
+                )
+            elif is_moe_layer[i] and share_moe_layers:
+                # only share params inside group
+                layer_plan.append(
+                    TiedLayerSpec(
+                        "moe" + "_group_" + str(i // group_size),
+                        MoEParallelTransformerLayerPipe,
+                        layer_number=i,
+                        **transformer_layer_kwargs,
+                    )
+                )
+            else:
+                layer_plan.append(
+                    LayerSpec(
+                        MoEParallelTransformerLayerPipe
+                        if is_moe_layer[i]
+                        else ParallelTransformerLayerPipe,
+                        layer_number=i,
+                        **transformer_layer_kwargs,
+                    )
+                )
+        return layer_plan
+
+    def _layer_partition_weights(self):
+        """
+        Estimated cost (~ parameter count) of each layer spec, used by the "moe_aware" partition method.
+        MoE layers are weighted by their number of experts, so they are not counted like dense layers.
+        """
+        h = self.neox_args.hidden_size
+        attention_weight = 4 * h**2
+        mlp_weight = 8 * h**2
+        weights = []
+        for spec in self._layer_specs:
+            layer_cls = spec.typename if isinstance(spec, LayerSpec) else None
+            if layer_cls is MoEParallelTransformerLayerPipe:
+                weights.append(attention_weight + mlp_weight * self.neox_args.moe_num_experts)
+            elif layer_cls in (ParallelTransformerLayerPipe, GMLPBlock):
+                weights.append(attention_weight + mlp_weight)
+            elif layer_cls in (EmbeddingPipe, ParallelLinearPipe):
+                weights.append(self.neox_args.padded_vocab_size * h)
+            else:
+                # norms and pipe helper functions
+                weights.append(0)
+        return weights
+
+    def _partition_layers(self, method="uniform"):
+        if method.lower() != "moe_aware":
+            return super()._partition_layers(method=method)
+
+        num_stages = self._topo.get_dim("pipe")
+        stage_id = self._topo.get_coord(self.global_rank).pipe
+        self.parts = ds_utils.partition_balanced(
+            weights=self._layer_partition_weights(), num_parts=num_stages
+        )
+        print_rank_0(f"moe_aware pipeline partition: {self.parts}")
+        self._set_bounds(start=self.parts[stage_id], stop=self.parts[stage_id + 1])
+
     def _set_parallel_output(self, value):
         # sets the parallel output value of the final layer to value
         final_layer = list(self.forward_funcs)[-1]
         if isinstance(final_layer, (ParallelLinearPipe, ParallelLinear)):
             final_layer.final_linear.set_parallel_output(value)
 
+    def _modules_with_attr(self, attr):
+        """
+        Returns the (sub)modules of `self.forward_funcs` that have `attr`. The module tree is only walked once
+        per attribute, and the result is reset whenever the layers are rebuilt.
+        """
+        if attr not in self._modules_with_attr_cache:
+            self._modules_with_attr_cache[attr] = [
+                m
+                for layer in self.forward_funcs
+                if isinstance(layer, torch.nn.Module)
+                for m in layer.modules()
+                if hasattr(m, attr)
+            ]
+        return self._modules_with_attr_cache[attr]
+
+    def _set_use_cache(self, use_cache):
+        assert isinstance(use_cache, bool), "Value is not the correct type."
+        for m in self._modules_with_attr("use_cache"):
+            m.use_cache = use_cache
+
     def inference_mode(self, use_cache=True):
         """
         Sets up the model for inference by turning on k/v caching (if specified) and setting `parallel output` of the final layer to false,
@@ -341,7 +441,7 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         :param cache: (bool) True if you want to use caching during inference, False otherwise
         """
         # first set caching to true if specified
-        recursive_setattr(self.forward_funcs, "use_cache", use_cache, assert_type=bool)
+        self._set_use_cache(use_cache)
         # then set parallel output of the final layer to false so we don't have to gather the output manually
         self._set_parallel_output(False)
         recursive_setattr(self.forward_funcs, "training", False)
@@ -352,16 +452,17 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         so logits are not gathered across model parallel ranks, and loss is computed in parallel (more efficient).
         """
         # set caching to false
-        recursive_setattr(self.forward_funcs, "use_cache", False)
+        self._set_use_cache(False)
         # then set parallel output to true (more efficient training)
         self._set_parallel_output(True)
         recursive_setattr(self.forward_funcs, "training", True)
 
     def clear_cache(self):
         """
-        Recursively clears the kv cache on all layers
+        Clears the kv cache on all layers
         """
-        recursive_setattr(self.forward_funcs, "layer_past", None)
+        for m in self._modules_with_attr("layer_past"):
+            m.layer_past = None
 
     def to_sequential(self):
         """
@@ -382,8 +483,10 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
                             spec.build(log=False, experts=experts)
                         )
                     else:
+                        # bind the owner module eagerly - a lambda closing over the loop variable `spec`
+                        # would late-bind to whichever spec the loop ended on
                         layers.append(
-                            Lambda(lambda x: spec.forward_fn(tied_layers[spec.key][0], x))
+                            Lambda(partial(spec.forward_fn, tied_layers[spec.key][0]))
                         )
                 else:
                     # owner
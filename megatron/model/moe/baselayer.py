@@ -49,6 +49,10 @@ class LocalExperts(torch.nn.Module):
         if input_split is None:
             return self._forward_with_chunks(inputs)
         
+        if isinstance(input_split, torch.Tensor):
+            # torch.split needs host ints. Syncing here rather than in the gate lets the token gather that produced
+            # `inputs` be queued on the device before the host blocks
+            input_split = splits_to_list(input_split)
         assert isinstance(input_split, list)
         assert len(inputs.shape) == 2
 
@@ -161,11 +165,78 @@ class BaseLayer(MOELayer):
         combined_outout = combined_outout.view_as(input[0])
         return combined_outout
     
+_arange_cache = {}
+
+
+def _cached_arange(n, device):
+    # read-only [0, n) index, sliced from one buffer per device that grows to the largest n seen
+    arange = _arange_cache.get(device)
+    if arange is None or arange.size(0) < n:
+        arange = torch.arange(0, n, device=device)
+        _arange_cache[device] = arange
+    return arange[:n]
+
+
+def topk_slots(combine_weights, dispatch_mask, k):
+    """
+    Turns the (s, e, c) gate outputs into the flat slot (e * c + c_idx) of each of the k routings of every token,
+    shape (s, k), and whether that routing was kept (False if the token was dropped for lack of capacity).
+    """
+    s = combine_weights.shape[0]
+    slots = combine_weights.reshape(s, -1).topk(k, dim=-1).indices
+    kept = dispatch_mask.reshape(s, -1).gather(1, slots)
+    return slots, kept
+
+
+def sparse_dispatch(reshaped_input, slots, kept, num_experts, capacity):
+    """
+    Same as einsum("sec,sm->ecm", dispatch_mask, reshaped_input) but only touches the s * k routed rows instead of
+    the mostly-zero (s, e, c) mask. Dropped routings add zeros, so no (syncing) boolean indexing is needed.
+    """
+    d_model = reshaped_input.shape[-1]
+    k = slots.shape[-1]
+    src = reshaped_input.repeat_interleave(k, dim=0) * kept.reshape(-1, 1).type_as(reshaped_input)
+    dispatched_input = reshaped_input.new_zeros(num_experts * capacity, d_model)
+    dispatched_input.index_add_(0, slots.reshape(-1), src)
+    return dispatched_input.reshape(num_experts, capacity, d_model)
+
+
+def sparse_combine(expert_output, slots, combine_weights):
+    """
+    Same as einsum("sec,ecm->sm", combine_weights, expert_output), gathering only the k slots of every token.
+    Dropped routings have a zero combine weight.
+    """
+    s, k = slots.shape
+    d_model = expert_output.shape[-1]
+    weights = combine_weights.reshape(s, -1).gather(1, slots).type_as(expert_output)
+    gathered = expert_output.reshape(-1, d_model).index_select(0, slots.reshape(-1))
+    return (gathered * weights.reshape(-1, 1)).reshape(s, k, d_model).sum(dim=1)
+
+
+_pinned_splits_cache = {}
+
+
+def splits_to_list(splits):
+    """
+    Copies a (small) device tensor of split sizes to the host as a python list, as needed by torch.split and
+    all_to_all_single. Goes through a reused pinned buffer instead of a fresh pageable one on every call.
+    """
+    if not splits.is_cuda:
+        return splits.tolist()
+    n = splits.numel()
+    host = _pinned_splits_cache.get((n, splits.dtype))
+    if host is None:
+        host = torch.empty(n, dtype=splits.dtype, pin_memory=True)
+        _pinned_splits_cache[(n, splits.dtype)] = host
+    host.copy_(splits.view(-1), non_blocking=True)
+    torch.cuda.current_stream().synchronize()
+    return host.tolist()
+
+
 def inverse_sort(order):
     # Creates an index that undoes a sort: xs==xs[order][inverse_sort(order)]
-    return torch.empty_like(order).scatter_(
-        0, order, torch.arange(0, order.size(0), device=order.device)
-    )
+    # the output is not cached: callers index with it, and autograd keeps that index around for the backward
+    return torch.empty_like(order).scatter_(0, order, _cached_arange(order.size(0), order.device))
 
 
 class BaseLayerGate(nn.Module):
@@ -203,12 +274,17 @@ class BaseLayerGate(nn.Module):
     
     def gather_scores(self, scores, sort_indices, input_splits):
         sorted_scores = scores[sort_indices]
+        # expert id of each sorted token, built on device instead of from a per-token python list
         if input_splits is None:
             num_tokens_per_experts = scores.shape[0] // scores.shape[1]
-            expert_indices = torch.tensor([i//num_tokens_per_experts for i in range(len(scores))])
+            expert_indices = torch.div(
+                _cached_arange(scores.shape[0], scores.device), num_tokens_per_experts, rounding_mode="floor")
         else:
-            expert_indices = torch.tensor(
-                [index for index, count in enumerate(input_splits) for _ in range(count)])
+            expert_indices = torch.repeat_interleave(
+                _cached_arange(len(input_splits), scores.device),
+                torch.tensor(input_splits, device=scores.device),
+                output_size=scores.shape[0],
+            )
         expert_indices = expert_indices.unsqueeze(dim=-1).type_as(sort_indices)
 
         gathed_scores = torch.gather(input=sorted_scores, dim=1, index=expert_indices)
@@ -223,7 +299,7 @@ class BaseLayerGate(nn.Module):
             scores[~ok] = scores[ok].min()
         
         input_split = [scores.shape[0] // scores.shape[1] for i in range(self.num_workers)]
-        output_split = All2All.apply(torch.tensor(input_split, device=scores.device), self.ep_group).tolist()
+        output_split = splits_to_list(All2All.apply(torch.tensor(input_split, device=scores.device), self.ep_group))
         return self.cpp_balanced_assignment(scores, False), input_split, output_split
     
     # Assigns each token to the top k experts
@@ -242,7 +318,7 @@ class BaseLayerGate(nn.Module):
         assert input_splits.sum() == scores.shape[0]
         # Tell other workers how many tokens to expect from us
         output_splits = All2All.apply(input_splits, self.ep_group)
-        return worker2token, input_splits.tolist(), output_splits.tolist()
+        return worker2token, splits_to_list(input_splits), splits_to_list(output_splits)
 
     def _load_assignment(self):
         try:
@@ -28,7 +28,8 @@ from torch.distributions import Multinomial
 from torch.nn import Module
 import copy
 from deepspeed.utils.logging import log_dist 
-from megatron.model.moe.baselayer import BaseLayer, inverse_sort, All2All, LocalExperts
+from megatron.model.moe.baselayer import BaseLayer, inverse_sort, All2All, LocalExperts, topk_slots, sparse_dispatch, sparse_combine
+from megatron.model.moe.overlap_moe import chunked_all_to_all, needs_tp_dedup
 
 class HierMoE(MoE):
     """
@@ -38,7 +39,7 @@ class HierMoE(MoE):
     def __init__(self, hidden_size, expert, num_experts=1, ep_size=1, k=1, capacity_factor=1, 
                  eval_capacity_factor=1, min_capacity=4, use_residual=False, noisy_gate_policy: str = None, 
                  drop_tokens: bool = True, use_rts=True, use_tutel: bool = False, enable_expert_tensor_parallelism: bool = False, 
-                 aux_loss_weight: dict = None, use_elbo=False, experts=None, gate_st=False, inside_k=1):
+                 aux_loss_weight: dict = None, use_elbo=False, experts=None, gate_st=False, inside_k=1, a2a_num_chunks=1):
         super(HierMoE, self).__init__(
             hidden_size=hidden_size, 
             expert=expert, 
@@ -76,7 +77,8 @@ class HierMoE(MoE):
                                         self.ep_size,
                                         self.num_local_experts,
                                         use_tutel=use_tutel,
-                                        use_elbo=use_elbo)
+                                        use_elbo=use_elbo,
+                                        a2a_num_chunks=a2a_num_chunks)
         else:
             self.deepspeed_moe = LocalMoELayer(insidegpu_gate,
                                         experts,
@@ -87,9 +89,12 @@ class HierMoE(MoE):
                                         use_elbo=use_elbo)
 
 class HierMoELayer(MOELayer):
-    def __init__(self, crossgpu_gate: Module, insidegpu_gate: Module, experts: Module, ep_group_name, ep_size, num_local_experts: int, use_tutel: bool = False, use_elbo=False) -> None:
+    _needs_tp_dedup = None
+
+    def __init__(self, crossgpu_gate: Module, insidegpu_gate: Module, experts: Module, ep_group_name, ep_size, num_local_experts: int, use_tutel: bool = False, use_elbo=False, a2a_num_chunks=1) -> None:
         super().__init__(crossgpu_gate, experts, ep_group_name, ep_size, num_local_experts=1, use_tutel=use_tutel, use_elbo=use_elbo)
         self.insidegpu_gate = insidegpu_gate
+        self.a2a_num_chunks = a2a_num_chunks
 
     def forward(self, *input: Tensor, **kwargs: Any) -> Tensor:
         if self.wall_clock_breakdown:
@@ -124,12 +129,13 @@ class HierMoELayer(MOELayer):
             else:
                 self.l_aux, combine_weights, dispatch_mask, self.exp_counts, crossgpu_probs = self.gate(
                     reshaped_input, used_token=input[1], return_gates=True)
-                
-            dispatched_input = einsum("sec,sm->ecm", dispatch_mask.type_as(input[0]), reshaped_input)
-        if self.wall_clock_breakdown:
-            self.timers('falltoall').start()
 
-        if groups._get_expert_model_parallel_world_size() == 1:
+            slots, kept = topk_slots(combine_weights, dispatch_mask, self.gate.k)
+            dispatched_input = sparse_dispatch(reshaped_input, slots, kept, *dispatch_mask.shape[1:])
+
+        if self._needs_tp_dedup is None:
+            self._needs_tp_dedup = needs_tp_dedup()
+        if self._needs_tp_dedup:
             # If the non-expert is tensor-parallel, it will create
             # duplicate tokens on the tensor-parallel ranks.
             # Since our experts are not tensor-parallel, these duplicates
@@ -138,6 +144,52 @@ class HierMoELayer(MOELayer):
             # reducing the all-to-all communication volume.
             dispatched_input = drop_tokens(dispatched_input, dim=1)
 
+        if self.ep_size != 1 and self.a2a_num_chunks > 1:
+            expert_output, insidegpu_probs = self._overlapped_local_moe(dispatched_input)
+        else:
+            expert_output, insidegpu_probs = self._local_moe_with_all_to_all(dispatched_input)
+
+        assert crossgpu_probs.shape[0] == insidegpu_probs.shape[0]
+        # the probs are non-negative, so the argmax of their outer product is the pair of the two argmaxes
+        num_inside_experts = insidegpu_probs.shape[-1]
+        global_indices = crossgpu_probs.argmax(dim=-1) * num_inside_experts + insidegpu_probs.argmax(dim=-1)
+        global_mask = F.one_hot(global_indices, num_classes=crossgpu_probs.shape[-1] * num_inside_experts)
+        # AuxLoss (deepspeed) takes the dense joint distribution, so the B x E1 x E2 probs are still materialized here
+        global_probs = torch.einsum('bi,bj->bij', crossgpu_probs, insidegpu_probs).reshape(crossgpu_probs.shape[0], -1)
+        aux_loss_weight = self.insidegpu_gate.aux_loss_weight
+        self.l_aux, global_metadata =  AuxLoss.get_auxloss(global_probs, global_mask, aux_loss_weight['load_balance'], aux_loss_weight['zloss'], aux_loss_weight['entropy'])
+        
+        global_metadata = {'global_' + key: value for key, value in global_metadata.items()}
+        self.exp_counts.update(global_metadata)
+
+        # Re-shape back: gecm -> ecm
+        expert_output = expert_output.reshape(self.ep_size * self.num_local_experts, -1, d_model)
+
+        if self._needs_tp_dedup:
+            # the dropped duplicate tokens need to be gathered on each
+            # tensor parallel rank again for the tensor-parallel
+            # non-expert of the next layer.
+            expert_output = gather_tokens(expert_output, dim=1)
+
+        if self.use_tutel:
+            combined_output = self._tutel_dispatcher.decode(expert_output.view(E * C, M))
+        else:
+            combined_output = sparse_combine(expert_output, slots, combine_weights)
+
+        a = combined_output.reshape(input[0].shape)
+
+        if self.wall_clock_breakdown:
+            self.timers('cross-moe').stop()
+            self.time_moe = self.timers('moe').elapsed(reset=False)
+
+        return a
+    
+    def _local_moe_with_all_to_all(self, dispatched_input):
+        d_model = dispatched_input.shape[-1]
+
+        if self.wall_clock_breakdown:
+            self.timers('falltoall').start()
+
         # TODO: if ep & tp, all2all can be improved to 2d, 
         # first split data in tp, and then all2all on ep, finally all-gather on tp
         if self.ep_size != 1:
@@ -151,15 +203,6 @@ class HierMoELayer(MOELayer):
         dispatched_input = dispatched_input.reshape(self.ep_size, self.num_local_experts, -1, d_model)
         expert_output, insidegpu_probs = self.local_moe(dispatched_input)
         assert dispatched_input.shape == expert_output.shape
-        
-        assert crossgpu_probs.shape[0] == insidegpu_probs.shape[0]
-        global_probs = torch.einsum('bi,bj->bij', crossgpu_probs, insidegpu_probs).reshape(crossgpu_probs.shape[0], -1) 
-        global_mask = F.one_hot(global_probs.argmax(dim=-1), num_classes=global_probs.shape[-1])
-        aux_loss_weight = self.insidegpu_gate.aux_loss_weight
-        self.l_aux, global_metadata =  AuxLoss.get_auxloss(global_probs, global_mask, aux_loss_weight['load_balance'], aux_loss_weight['zloss'], aux_loss_weight['entropy'])
-        
-        global_metadata = {'global_' + key: value for key, value in global_metadata.items()}
-        self.exp_counts.update(global_metadata)
 
         if self.wall_clock_breakdown:
             self.timers('salltoall').start()
@@ -171,28 +214,37 @@ class HierMoELayer(MOELayer):
             self.timers('salltoall').stop()
             self.time_salltoall = self.timers('salltoall').elapsed(reset=False)
 
-        # Re-shape back: gecm -> ecm
-        expert_output = expert_output.reshape(self.ep_size * self.num_local_experts, -1, d_model)
+        return expert_output, insidegpu_probs
 
-        if groups._get_expert_model_parallel_world_size() == 1:
-            # the dropped duplicate tokens need to be gathered on each
-            # tensor parallel rank again for the tensor-parallel
-            # non-expert of the next layer.
-            expert_output = gather_tokens(expert_output, dim=1)
+    def _overlapped_local_moe(self, dispatched_input):
+        """
+        Same as _local_moe_with_all_to_all, but split into a2a_num_chunks chunks along the capacity dim so that the
+        all-to-alls of one chunk run while local_moe works on another (see overlap_moe.chunked_all_to_all).
+        """
+        d_model = dispatched_input.shape[-1]
+        chunk_probs = []
 
-        if self.use_tutel:
-            combined_output = self._tutel_dispatcher.decode(expert_output.view(E * C, M))
-        else:
-            combined_output = einsum("sec,ecm->sm", combine_weights.type_as(input[0]), expert_output)
+        def local_moe_chunk(chunk):
+            # ecm -> gecm
+            chunk = chunk.reshape(self.ep_size, self.num_local_experts, -1, d_model)
+            expert_output, probs = self.local_moe(chunk)
+            chunk_probs.append(probs.reshape(self.ep_size, -1, probs.shape[-1]))
+            return expert_output.reshape(self.ep_size * self.num_local_experts, -1, d_model)
 
-        a = combined_output.reshape(input[0].shape)
+        if self.wall_clock_breakdown:
+            self.timers('falltoall').start()
+
+        expert_output = chunked_all_to_all(self.ep_group, dispatched_input, local_moe_chunk, self.a2a_num_chunks)
 
         if self.wall_clock_breakdown:
-            self.timers('cross-moe').stop()
-            self.time_moe = self.timers('moe').elapsed(reset=False)
+            # both all-to-alls overlap with local_moe, so they can only be timed together with it under falltoall
+            self.timers('falltoall').stop()
+            self.time_falltoall = self.timers('falltoall').elapsed(reset=False)
+
+        # put the probs back in the (g, c) token order of the unchunked path
+        insidegpu_probs = torch.cat(chunk_probs, dim=1).reshape(-1, chunk_probs[0].shape[-1])
+        return expert_output, insidegpu_probs
 
-        return a
-    
     def local_moe(self, inputs):
         if self.wall_clock_breakdown:
             self.timers('inside-moe').start()
@@ -316,11 +368,7 @@ class LocalMoELayer(HierMoELayer):
          
         return expert_output
 
-def reverse_sort(order):
-    # Creates an index that undoes a sort: xs==xs[order][inverse_sort(order)]
-    return torch.empty_like(order).scatter_(
-        0, order, torch.arange(0, order.size(0), device=order.device)
-    )
+reverse_sort = inverse_sort
 
 class LocalGate(torch.nn.Module):
     def __init__(self,
@@ -331,7 +379,7 @@ class LocalGate(torch.nn.Module):
                  expert_group_name,
                  k: int = 1):
         super().__init__()
-        self.wg = torch.nn.Linear(model_dim, num_experts, bias=False).float() 
+        self.wg = torch.nn.Linear(model_dim, num_experts, bias=False)
         self.num_experts = num_experts
         self.k = k
         self.aux_loss_weight = aux_loss_weight
@@ -342,29 +390,29 @@ class LocalGate(torch.nn.Module):
 
 
     def forward(self,
-                inputs: torch.Tensor) -> Tuple[Tensor, Tensor, list, Tensor, Tensor]:  # type: ignore
-            if self.wg.weight.dtype != torch.float32:
-                self.wg = self.wg.float()
-            input_fp32 = inputs.float()
-                
-            logits = self.wg(input_fp32)
-            probs = torch.softmax(logits, dim=-1)
-            topk_probs, topk_indices = torch.topk(probs, dim=-1, k=self.k, largest=True)
+                inputs: torch.Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]:  # type: ignore
+            # the gate linear runs in the training dtype, only the softmax needs fp32
+            logits = self.wg(inputs)
+            probs = torch.softmax(logits.float(), dim=-1)
+            if self.k == 1:
+                # a plain max reduction instead of the generic topk kernel
+                topk_probs, topk_indices = probs.max(dim=-1, keepdim=True)
+            else:
+                topk_probs, topk_indices = torch.topk(probs, dim=-1, k=self.k, largest=True)
             topk_indices = topk_indices.view(-1) # indices of expected experts for each token
             assert topk_indices.numel() == probs.shape[0] * self.k
             # mask = F.one_hot(probs.argmax(dim=-1), num_classes=self.num_experts)
             # assert mask.shape == probs.shape
 
-            sorted_topk_indices, sort_ordering = torch.sort(topk_indices) # sort tokens according to the expert-id of their corresponding experts
+            _, sort_ordering = torch.sort(topk_indices) # sort tokens according to the expert-id of their corresponding experts
             reversed_ordering = reverse_sort(sort_ordering)
             sort_ordering = sort_ordering // self.k # map token*k -> token
 
-            # Find how many tokens we're sending to each other worker (being careful for sending 0 tokens to some workers)
+            # Find how many tokens we're sending to each expert (experts receiving no tokens get 0).
+            # Not torch.bincount: on CUDA its bounds checks sync with the host twice
             input_splits = torch.zeros(
-                (self.num_experts,), dtype=torch.long, device=logits.device
-            )
-            workers, counts = torch.unique_consecutive(sorted_topk_indices, return_counts=True) # count how many tokens each expert received
-            input_splits[workers] = counts
+                self.num_experts, dtype=torch.long, device=topk_indices.device
+            ).scatter_add_(0, topk_indices, torch.ones_like(topk_indices))
 
             if self.k > 1:
                 combine_weights = torch.softmax(topk_probs, dim=-1)
@@ -373,5 +421,6 @@ class LocalGate(torch.nn.Module):
             combine_weights = combine_weights.view(-1).type_as(inputs)
             if self.gate_st:
                 combine_weights = combine_weights-combine_weights.detach() + 1
-            assert input_splits.sum() == len(sort_ordering)
-            return sort_ordering, reversed_ordering, combine_weights, input_splits.tolist(), probs
\ No newline at end of file
+            # nothing above syncs with the host. input_splits stays on device, LocalExperts copies it to the host
+            # (the one unconditional sync left on this path) once the dispatch is queued
+            return sort_ordering, reversed_ordering, combine_weights, input_splits, probs
\ No newline at end of file
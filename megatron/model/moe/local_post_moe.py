@@ -2,14 +2,18 @@ import torch
 from deepspeed.moe.sharded_moe import MOELayer, einsum, _AllToAll
 from deepspeed.moe.layer import MoE, Experts
 from torch.nn import Module
+from megatron.model.moe.baselayer import topk_slots, sparse_dispatch, sparse_combine
 
 def assert_all_experts_are_same(experts):
-    def assert_two_modules_are_same(m1, m2):
-        for p1, p2 in zip(m1.parameters(), m2.parameters()):
+    # same check as torch.allclose on every parameter pair, but the results are combined on device so that
+    # there is one host sync in total instead of one per parameter per expert
+    first_params = list(experts.experts[0].parameters())
+    all_close = torch.ones((), dtype=torch.bool, device=first_params[0].device)
+    for e in experts.experts[1:]:
+        for p1, p2 in zip(first_params, e.parameters()):
             assert p1.data.shape == p2.data.shape
-            assert torch.allclose(p1.data, p2.data)
-    for e in experts.experts:
-        assert_two_modules_are_same(e, experts.experts[0])
+            all_close &= torch.isclose(p2.data, p1.data).all()
+    assert all_close.item()
 
 def assert_close(x1, x2):
     assert torch.allclose(x1, x2, atol=1e-6), f'max distance:{torch.max(torch.abs(x1-x2))}'
@@ -47,9 +51,8 @@ class LocalPostMoELayer(MOELayer):
         reshaped_inputs = inputs[0].reshape(-1, d_model)
 
         self.l_aux, combine_weights, dispatch_mask, self.exp_counts = self.gate(reshaped_inputs, inputs[1])
-        dispatched_inputs = einsum(
-            "sec,sm->ecm", dispatch_mask.type_as(inputs[0]), reshaped_inputs
-        )  # TODO: heavy memory usage due to long sequence length
+        slots, kept = topk_slots(combine_weights, dispatch_mask, self.gate.k)
+        dispatched_inputs = sparse_dispatch(reshaped_inputs, slots, kept, *dispatch_mask.shape[1:])
 
 
         dispatched_inputs = _AllToAll.apply(self.ep_group, dispatched_inputs)
@@ -66,9 +69,9 @@ class LocalPostMoELayer(MOELayer):
 
         if self.gate.k == 1:
             combine_weights = combine_weights-combine_weights.detach() + dispatch_mask
-        combined_output = einsum("sec,ecm->sm", combine_weights.type_as(inputs[0]), expert_output)
+        combined_output = sparse_combine(expert_output, slots, combine_weights)
 
-        routed_mask = (dispatch_mask!=0).any(-1).any(-1)
+        routed_mask = kept.any(dim=-1)
         
         dense_outputs = self.experts(reshaped_inputs)
         assert_close(combined_output[routed_mask], dense_outputs[routed_mask])
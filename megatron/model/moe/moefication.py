@@ -2,7 +2,8 @@ from deepspeed.moe.layer import MoE, MOELayer, TopKGate, Experts
 from deepspeed.moe.sharded_moe import einsum, _AllToAll
 from torch.nn import Module
 import torch
-from megatron.model.moe.baselayer import BaseLayer
+import torch.nn.functional as F
+from megatron.model.moe.baselayer import BaseLayer, topk_slots, sparse_dispatch, sparse_combine
 from megatron.model.moe.hier_moe import HierBalancedMoELayer, LocalGate, LocalExperts
 from megatron.model.moe.moefication_router import ShiftPriorityTopKGate, KthGate
 from deepspeed.utils.logging import log_dist
@@ -73,16 +74,27 @@ class MoeFromDense(MoE):
         #                         use_elbo=use_elbo)
 
 def assert_all_experts_are_same(experts):
-    def assert_two_modules_are_same(m1, m2):
-        for p1, p2 in zip(m1.parameters(), m2.parameters()):
+    # same check as torch.allclose on every parameter pair, but the results are combined on device so that
+    # there is one host sync in total instead of one per parameter per expert
+    first_params = list(experts.deepspeed_experts[0].parameters())
+    all_close = torch.ones((), dtype=torch.bool, device=first_params[0].device)
+    for e in experts.deepspeed_experts[1:]:
+        for p1, p2 in zip(first_params, e.parameters()):
             assert p1.data.shape == p2.data.shape
-            assert torch.allclose(p1.data, p2.data)
-    for e in experts.deepspeed_experts:
-        assert_two_modules_are_same(e, experts.deepspeed_experts[0])
+            all_close &= torch.isclose(p2.data, p1.data).all()
+    assert all_close.item()
 
 def assert_close(x1, x2):
     assert torch.allclose(x1, x2, atol=1e-6), f'max distance:{torch.max(torch.abs(x1-x2))}'
 
+@torch.jit.script
+def blend_post_routed(post_routing_outputs, post_routing_probs, local_scale, topk_norm, routed_outputs, eps: float):
+    # mixes the post-routed expert outputs into the (partial) top-k outputs, weighted by their routing probs
+    local_norm = (post_routing_probs * local_scale).detach()
+    new_norm = torch.clamp(topk_norm + local_norm, min=eps)
+    return (post_routing_outputs * post_routing_probs * local_scale + topk_norm * routed_outputs) / new_norm
+
+
 class LocalPostMoELayer(MOELayer):
     def __init__(self,
                     gate: Module,
@@ -97,6 +109,7 @@ class LocalPostMoELayer(MOELayer):
         super().__init__(gate, experts, ep_group_name, ep_size, num_local_experts, use_tutel, use_elbo)
         self.unrouted_type=unrouted_type
         self.num_experts = self.gate.wg.weight.shape[0]
+        self.ep_rank = None # the ep group is only set after construction, see post_routing
 
     @classmethod
     def from_moe_layer(cls, moe_layer:MOELayer):
@@ -113,9 +126,8 @@ class LocalPostMoELayer(MOELayer):
 
         self.l_aux, combine_weights, dispatch_mask, self.exp_counts, routing_probs, topk_norm = self.gate(
             reshaped_inputs, inputs[1], return_gates=True)
-        dispatched_inputs = einsum(
-            "sec,sm->ecm", dispatch_mask.type_as(inputs[0]), reshaped_inputs
-        )  # TODO: heavy memory usage due to long sequence length
+        slots, kept = topk_slots(combine_weights, dispatch_mask, self.gate.k)
+        dispatched_inputs = sparse_dispatch(reshaped_inputs, slots, kept, *dispatch_mask.shape[1:])
 
 
         dispatched_inputs = _AllToAll.apply(self.ep_group, dispatched_inputs)
@@ -135,44 +147,46 @@ class LocalPostMoELayer(MOELayer):
             # combine_weights = dispatch_mask
             self.unrouted_type = 'all'
         
-        combined_output = einsum("sec,ecm->sm", combine_weights.type_as(inputs[0]), expert_output)
+        combined_output = sparse_combine(expert_output, slots, combine_weights)
 
-        combine_weights_sum = dispatch_mask.sum(dim=-1).sum(dim=-1) # number of experts that each token is sent to
+        combine_weights_sum = kept.sum(dim=-1) # number of experts that each token is sent to
         if self.unrouted_type == 'all': # only tokens dropped at all top-k routings are post routed
             routed_mask = (combine_weights_sum != 0)
         elif self.unrouted_type == 'any': # any dropped tokens are post routed
             routed_mask = (combine_weights_sum == self.gate.k) 
         elif self.unrouted_type == 'ignore_kth': # ignore the dropped tokens at the kth routing. only consider the dropped tokens at top-(k-1) routings
             routed_mask = (combine_weights_sum >= self.gate.k-1) # assume that the dropped routing must be the kth routing
-        unrouted_mask = ~routed_mask
+        # compact the unrouted tokens once and reuse the index for every gather and the final write
+        unrouted_indices = (~routed_mask).nonzero(as_tuple=True)[0]
 
         # postprocess unrouted tokens
-        masked_routing_probs = routing_probs[unrouted_mask].type_as(combined_output) # routing probs of unrouted tokens
-        post_routing_outputs, post_routing_probs = self.post_routing(reshaped_inputs[unrouted_mask], masked_routing_probs)
+        masked_routing_probs = routing_probs.index_select(0, unrouted_indices).type_as(combined_output) # routing probs of unrouted tokens
+        post_routing_outputs, post_routing_probs = self.post_routing(
+            reshaped_inputs.index_select(0, unrouted_indices), masked_routing_probs)
 
         # normalization
-        topk_norm = topk_norm[unrouted_mask].unsqueeze(dim=-1).type_as(combined_output)
+        topk_norm = topk_norm.index_select(0, unrouted_indices).unsqueeze(dim=-1).type_as(combined_output)
 
         assert topk_norm.shape == post_routing_probs.shape, f'{topk_norm.shape=}, {post_routing_probs.shape=}'
-        local_scale = (self.gate.k-combine_weights_sum[unrouted_mask].unsqueeze(dim=-1)).detach().type_as(combined_output)
-        local_norm = (post_routing_probs * local_scale).detach()
+        local_scale = (self.gate.k-combine_weights_sum.index_select(0, unrouted_indices).unsqueeze(dim=-1)).detach().type_as(combined_output)
 
-        new_norm = torch.clamp(topk_norm + local_norm, min=torch.finfo(combine_weights.dtype).eps)
-        combined_output[unrouted_mask] = (
-            post_routing_outputs * post_routing_probs * local_scale \
-                  + topk_norm * combined_output[unrouted_mask]) / new_norm
+        combined_output.index_copy_(0, unrouted_indices, blend_post_routed(
+            post_routing_outputs, post_routing_probs, local_scale, topk_norm,
+            combined_output.index_select(0, unrouted_indices), torch.finfo(combine_weights.dtype).eps))
         out = combined_output.reshape(inputs[0].shape)
         
         return out
     
     def post_routing(self, inputs:Tensor, routing_scores):
         assert inputs.shape[0] == routing_scores.shape[0]
-        self.ep_rank = torch.distributed.get_rank(self.ep_group)
-        self.ep_world_size = torch.distributed.get_world_size(self.ep_group)
-        assert self.ep_world_size * self.num_local_experts == self.num_experts, f"{self.ep_world_size=}, {self.num_local_experts=}"
-        
-        expert_indices = [i+self.ep_rank * self.num_local_experts for i in range(self.num_local_experts)]
-        local_routing_scores = routing_scores[:, expert_indices]
+        if self.ep_rank is None:
+            self.ep_rank = torch.distributed.get_rank(self.ep_group)
+            self.ep_world_size = torch.distributed.get_world_size(self.ep_group)
+            assert self.ep_world_size * self.num_local_experts == self.num_experts, f"{self.ep_world_size=}, {self.num_local_experts=}"
+
+        # the local experts are a contiguous range of expert ids, so slice instead of gathering
+        first_local_expert = self.ep_rank * self.num_local_experts
+        local_routing_scores = routing_scores[:, first_local_expert:first_local_expert + self.num_local_experts]
 
         if self.num_local_experts == 1:           
             return self.experts(inputs), local_routing_scores
@@ -205,12 +219,8 @@ class BalancedPostMoELayer(LocalPostMoELayer):
         num_experts = self.gate.wg.weight.shape[0]
         if inputs.shape[0] < num_experts or inputs.shape[0] % num_experts != 0:
             pad_len = num_experts - inputs.shape[0] % num_experts
-            padded_inputs = torch.cat(
-                [
-                    inputs, 
-                    torch.zeros([pad_len, inputs.shape[-1]], dtype=inputs.dtype, device=inputs.device)
-                ], dim=0
-            )
+            # zero rows at the end, in one allocation (no separate zeros tensor + cat)
+            padded_inputs = F.pad(inputs, (0, 0, 0, pad_len))
             results =  self.base_layer(padded_inputs)
             results = results[:-pad_len]
         else:
@@ -0,0 +1,157 @@
+from typing import Any
+from deepspeed.moe.layer import MoE, MOELayer
+from deepspeed.moe.sharded_moe import (
+    groups,
+    drop_tokens,
+    gather_tokens,
+)
+import torch
+import torch.distributed as dist
+from torch import Tensor
+from megatron import mpu
+from megatron.model.moe.baselayer import topk_slots, sparse_dispatch, sparse_combine
+
+
+def needs_tp_dedup():
+    """
+    Whether the tokens are duplicated over the tensor-parallel ranks, so the dispatched tokens have to go through
+    drop_tokens / gather_tokens around the all-to-all. Needs the process groups, so call it from forward.
+    """
+    return groups._get_expert_model_parallel_world_size() == 1 and mpu.get_model_parallel_world_size() > 1
+
+
+class AsyncAllToAll(torch.autograd.Function):
+    """
+    All-to-all that returns before the communication has finished. The work handle is appended to `handles` and has
+    to be waited on before the output is read. The backward is a regular (blocking) all-to-all.
+    """
+
+    @staticmethod
+    def forward(ctx, group, inputs, handles):
+        ctx.group = group
+        inputs = inputs.contiguous()
+        output = torch.empty_like(inputs)
+        handles.append(dist.all_to_all_single(output, inputs, group=group, async_op=True))
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.contiguous()
+        grad_input = torch.empty_like(grad_output)
+        dist.all_to_all_single(grad_input, grad_output, group=ctx.group)
+        return None, grad_input, None
+
+
+def chunked_all_to_all(ep_group, dispatched_input, expert_fn, num_chunks):
+    """
+    Sends `dispatched_input` (e, c, m) to the expert-parallel ranks, applies `expert_fn` and sends the results back,
+    splitting the capacity dim into `num_chunks` so that the expert computation of one chunk overlaps with the
+    all-to-alls of the others. Tokens are independent of each other, so the result is the same as without chunking.
+    """
+    # all dispatch all-to-alls are issued up front, they run while the experts work on the earlier chunks
+    dispatch_handles = []
+    routed_chunks = [
+        AsyncAllToAll.apply(ep_group, chunk, dispatch_handles)
+        for chunk in dispatched_input.chunk(num_chunks, dim=1)
+    ]
+
+    combine_handles = []
+    output_chunks = []
+    for routed_chunk, handle in zip(routed_chunks, dispatch_handles):
+        handle.wait()
+        output_chunks.append(
+            AsyncAllToAll.apply(ep_group, expert_fn(routed_chunk), combine_handles)
+        )
+    for handle in combine_handles:
+        handle.wait()
+    return torch.cat(output_chunks, dim=1)
+
+
+class OverlappedMoE(MoE):
+    """
+    deepspeed MoE whose all-to-alls are overlapped with the expert computation, see OverlappedMoELayer
+    """
+
+    def __init__(self, hidden_size, expert, num_chunks=2, **kwargs):
+        super(OverlappedMoE, self).__init__(hidden_size=hidden_size, expert=expert, **kwargs)
+        self.deepspeed_moe = OverlappedMoELayer.from_moe_layer(self.deepspeed_moe, num_chunks)
+
+
+class OverlappedMoELayer(MOELayer):
+    """
+    GShard-style MoE layer that splits the dispatched tokens into `num_chunks` chunks along the capacity dim. The
+    all-to-all of chunk k+1 (and the return all-to-all of chunk k-1) overlaps with the expert computation of chunk k.
+    """
+
+    _needs_tp_dedup = None
+
+    def __init__(self, gate, experts, ep_group_name, ep_size, num_local_experts: int, use_tutel: bool = False,
+                 use_elbo=False, num_chunks=2) -> None:
+        assert not use_tutel, "OverlappedMoELayer does not support tutel"
+        super(OverlappedMoELayer, self).__init__(gate, experts, ep_group_name, ep_size, num_local_experts, use_tutel,
+                                                 use_elbo)
+        self.num_chunks = num_chunks
+
+    @classmethod
+    def from_moe_layer(cls, moe_layer: MOELayer, num_chunks):
+        return cls(moe_layer.gate, moe_layer.experts, moe_layer.ep_group_name, moe_layer.ep_size,
+                   moe_layer.num_local_experts, use_tutel=moe_layer.use_tutel, use_elbo=moe_layer.use_elbo,
+                   num_chunks=num_chunks)
+
+    def _experts_forward(self, dispatched_input):
+        d_model = dispatched_input.shape[-1]
+        # Re-shape after all-to-all: ecm -> gecm
+        dispatched_input = dispatched_input.reshape(self.ep_size, self.num_local_experts, -1, d_model)
+        expert_output = self.experts(dispatched_input)
+        # Re-shape back: gecm -> ecm
+        return expert_output.reshape(self.ep_size * self.num_local_experts, -1, d_model)
+
+    def forward(self, *input: Tensor, **kwargs: Any) -> Tensor:
+        if self.wall_clock_breakdown:
+            self.timers('moe').start()
+
+        d_model = input[0].shape[-1]
+
+        # Reshape into S tokens by dropping sequence dimension.
+        reshaped_input = input[0].reshape(-1, d_model)
+        if self.use_elbo and self.training:
+            shifted_input = torch.cat([input[0][1:,:], input[0][-1:,:]], dim=0) # input: (seq, bsz, d_model)
+            self.l_aux, combine_weights, dispatch_mask, self.exp_counts = self.gate(
+                reshaped_input, shifted_input=shifted_input.reshape(-1, d_model), used_token=input[1])
+        else:
+            self.l_aux, combine_weights, dispatch_mask, self.exp_counts = self.gate(reshaped_input, input[1])
+        slots, kept = topk_slots(combine_weights, dispatch_mask, self.gate.k)
+        dispatched_input = sparse_dispatch(reshaped_input, slots, kept, *dispatch_mask.shape[1:])
+
+        if self._needs_tp_dedup is None:
+            self._needs_tp_dedup = needs_tp_dedup()
+        if self._needs_tp_dedup:
+            # tensor-parallel ranks hold duplicate tokens, only send each token once (see deepspeed MOELayer)
+            dispatched_input = drop_tokens(dispatched_input, dim=1)
+
+        if self.wall_clock_breakdown:
+            self.timers('falltoall').start()
+
+        if self.ep_size == 1:
+            # no all-to-all, nothing to overlap with
+            expert_output = self._experts_forward(dispatched_input)
+        else:
+            expert_output = chunked_all_to_all(
+                self.ep_group, dispatched_input, self._experts_forward, self.num_chunks)
+
+        if self.wall_clock_breakdown:
+            # both all-to-alls overlap with the expert computation, so they can only be timed together with it
+            self.timers('falltoall').stop()
+            self.time_falltoall = self.timers('falltoall').elapsed(reset=False)
+
+        if self._needs_tp_dedup:
+            expert_output = gather_tokens(expert_output, dim=1)
+
+        combined_output = sparse_combine(expert_output, slots, combine_weights)
+        combined_output = combined_output.reshape(input[0].shape)
+
+        if self.wall_clock_breakdown:
+            self.timers('moe').stop()
+            self.time_moe = self.timers('moe').elapsed(reset=False)
+
+        return combined_output
@@ -7,6 +7,7 @@ from megatron.model.moe.share_layer_moe import LayerAwareMoE
 from megatron.model.moe.moefication import MoeFromDense
 from megatron.model.moe.hier_moe import HierMoE
 from megatron.model.moe.baselayer import BaseLayerMoE
+from megatron.model.moe.overlap_moe import OverlappedMoE
 from functools import partial 
 
 class MoEParallelTransformerLayer(ParallelTransformerLayer):
@@ -20,7 +21,9 @@ class MoEParallelTransformerLayer(ParallelTransformerLayer):
         elif neox_args.moe_base_layer:
             MOE_CLS = BaseLayerMoE
         elif neox_args.hier_moe is not None:
-            MOE_CLS = partial(HierMoE, **neox_args.hier_moe)
+            MOE_CLS = partial(HierMoE, a2a_num_chunks=neox_args.moe_a2a_num_chunks, **neox_args.hier_moe)
+        elif neox_args.moe_a2a_num_chunks > 1:
+            MOE_CLS = partial(OverlappedMoE, num_chunks=neox_args.moe_a2a_num_chunks)
         else:
             MOE_CLS = deepspeed.moe.layer.MoE
         self.moe_layer = MOE_CLS(
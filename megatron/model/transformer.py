@@ -358,7 +358,8 @@ class ParallelSelfAttention(nn.Module):
 
         self.attention_config = neox_args.attention_config[layer_number]
         self.use_flash_attention = self.attention_config == "flash"
-        self.sparse = self.attention_config not in ("global", "flash")
+        self.use_sdpa = self.attention_config == "sdpa"
+        self.sparse = self.attention_config not in ("global", "flash", "sdpa")
         if self.sparse:
             self.sparse_attn = configure_sparse_attention(
                 neox_args,
@@ -372,6 +373,18 @@ class ParallelSelfAttention(nn.Module):
                 self.flash_triton_fn = None
                 self.flash_qkv_fn = flash_attn_func
                 self.flash_varlen_qkv_fn = flash_attn_varlen_func
+            elif self.use_sdpa:
+                assert self.pos_emb not in (
+                    "rpe",
+                    "alibi",
+                ), f"sdpa attention does not support {self.pos_emb} positional embeddings"
+                # F.scaled_dot_product_attention always scales by 1 / sqrt(hn), so any other
+                # softmax scale (query-key layer scaling, mup) is folded into the query instead
+                self.sdpa_query_scale = (
+                    (coeff if coeff is not None else 1.0)
+                    * math.sqrt(self.hidden_size_per_attention_head)
+                    / self.norm_factor
+                )
             else:
                 self.scale_mask_softmax = FusedScaleMaskSoftmax(
                     input_in_fp16=self.fp16,
@@ -600,6 +613,32 @@ class ParallelSelfAttention(nn.Module):
 
         return matmul_result
 
+    def sdpa_attention(self, query_layer, key_layer, value_layer):
+        # the causal mask is applied inside the kernel, so neither the [b, np, sq, sk]
+        # attention mask nor the attention scores are materialized
+        # [sq, b, np, hn] -> [b, np, sq, hn]
+        query_layer, key_layer, value_layer = map(
+            lambda t: t.permute(1, 2, 0, 3),
+            (query_layer, key_layer, value_layer),
+        )
+        if self.num_kv_heads_per_partition != self.num_attention_heads_per_partition:
+            repeats = (
+                self.num_attention_heads_per_partition
+                // self.num_kv_heads_per_partition
+            )
+            key_layer = key_layer.repeat_interleave(repeats, dim=1)
+            value_layer = value_layer.repeat_interleave(repeats, dim=1)
+        if self.sdpa_query_scale != 1.0:
+            query_layer = query_layer * self.sdpa_query_scale
+        # output shape [b, np, sq, hn]
+        return F.scaled_dot_product_attention(
+            query_layer,
+            key_layer,
+            value_layer,
+            dropout_p=self.dropout_p if self.training else 0.0,
+            is_causal=True,
+        )
+
     def sparse_attention(self, query_layer, key_layer, value_layer, attention_mask):
         # TODO: sparse attn dropout?
         # TODO: pad to block size
@@ -730,9 +769,11 @@ class ParallelSelfAttention(nn.Module):
 
         if self.use_cache:
             present = torch.stack((key_layer, value_layer))
-            assert not self.use_flash_attention and not self.sparse, self.attention_config
+            assert not self.use_flash_attention and not self.use_sdpa and not self.sparse, self.attention_config
         if self.use_flash_attention:
             context_layer = self.flash_attention(query_layer, key_layer, value_layer)
+        elif self.use_sdpa:
+            context_layer = self.sdpa_attention(query_layer, key_layer, value_layer)
         elif not self.sparse:
             context_layer = self.attention(
                 query_layer, key_layer, value_layer, layer_past, attention_mask
@@ -965,7 +1006,7 @@ class ParallelLinearPipe(ParallelLinear):
     """Another helper class to pass presents through to the output when doing inference with a Pipe Parallel model"""
 
     def forward(self, args):
-        # support list args
+        # support list args, e.g. the MoE pipeline output, which is passed on as a plain tuple
         if isinstance(args, (list, tuple)):
             hidden_state = args[0]
             logits, bias = super().forward(hidden_state)
@@ -986,7 +1027,7 @@ class NormPipe(nn.Module):
         # assert not isinstance(
         #     args, tuple
         # ), "NormPipe should only receive a single tensor as input"
-        # support additional args
+        # support additional args, e.g. the MoE pipeline output, which is passed on as a plain tuple
         if isinstance(args, (list, tuple)):
             return self.norm(args[0]), *args[1:]
         else:
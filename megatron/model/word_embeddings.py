@@ -131,9 +131,13 @@ class Embedding(torch.nn.Module):
         # Initialize the token-type embeddings.
         self.init_method(self.tokentype_embeddings.weight)
 
-    def forward(self, input_ids, position_ids, tokentype_ids=None):
+    def forward(self, input_ids, position_ids, tokentype_ids=None, seq_first=False):
+        # if seq_first, we look up the transposed (cheap) index tensors so the embeddings come out
+        # as [s, b, h] directly, rather than transposing the [b, s, h] activations afterwards
         # Embeddings.
-        words_embeddings = self.word_embeddings(input_ids)
+        words_embeddings = self.word_embeddings(
+            input_ids.t() if seq_first else input_ids
+        )
         if self.use_pos_emb and self.embedding_type in ["learned", "sinusoidal"]:
             if self.opt_pos_emb_offset:
                 if self.layer_past is not None:
@@ -142,13 +146,17 @@ class Embedding(torch.nn.Module):
                 # OPT always adds 2 for some reason, according to the HF implementation
                 position_ids = position_ids + self.opt_pos_emb_offset
             position_embeddings = self.position_embeddings(position_ids)
+            if seq_first:
+                position_embeddings = position_embeddings.transpose(0, 1)
             position_embeddings.mul_(self.mup_rp_embedding_mult)
             embeddings = words_embeddings + position_embeddings
         else:
             embeddings = words_embeddings
         if tokentype_ids is not None:
             assert self.tokentype_embeddings is not None
-            embeddings = embeddings + self.tokentype_embeddings(tokentype_ids)
+            embeddings = embeddings + self.tokentype_embeddings(
+                tokentype_ids.t() if seq_first else tokentype_ids
+            )
         else:
             assert self.tokentype_embeddings is None
 
@@ -163,7 +171,10 @@ class Embedding(torch.nn.Module):
 
 
 class EmbeddingPipe(Embedding):
-    """Extends Embedding to forward attention_mask through the pipeline."""
+    """Extends Embedding to forward attention_mask through the pipeline.
+
+    Hidden states are emitted in [s, b, h] layout, as expected by the transformer layers.
+    """
 
     @property
     def word_embeddings_weight(self):
@@ -178,7 +189,7 @@ class EmbeddingPipe(Embedding):
         input_ids = args[0]
         position_ids = args[1]
         attention_mask = args[2]
-        embeddings = super().forward(input_ids, position_ids)
+        embeddings = super().forward(input_ids, position_ids, seq_first=True)
         return embeddings, attention_mask
 
 
@@ -224,18 +235,19 @@ class SoftEmbedding(torch.nn.Module):
             embedding, attention_mask = args
         else:
             embedding, layer_past, attention_mask = args
-        soft_embedding = self.soft_embedding_weight.repeat(
-            embedding.shape[0], 1, 1
+        # embedding: [s, b, h]
+        soft_embedding = self.soft_embedding_weight.unsqueeze(1).repeat(
+            1, embedding.shape[1], 1
         )  # repeat batch_size times
         if in_train:
             # append soft embedding at the beginning in training
-            embedding = torch.cat((soft_embedding, embedding), dim=1)
-            embedding = embedding[:, : self.neox_args.seq_length, ...]
+            embedding = torch.cat((soft_embedding, embedding), dim=0)
+            embedding = embedding[: self.neox_args.seq_length, ...]
             return embedding, attention_mask
         else:
             if not (exists(layer_past) and layer_past.numel() > 0):
                 # if in inference, on the first forward pass, we want to do the same as in training (append soft embedding)
-                embedding = torch.cat((soft_embedding, embedding), dim=1)
-                embedding = embedding[:, : self.neox_args.seq_length, ...]
+                embedding = torch.cat((soft_embedding, embedding), dim=0)
+                embedding = embedding[: self.neox_args.seq_length, ...]
             # otherwise, we're in incremental mode, and just want to forward the single embedding (since the soft prompt has already been cached)
             return embedding, layer_past, attention_mask
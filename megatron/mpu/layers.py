@@ -29,6 +29,8 @@ from torch.nn.parameter import Parameter
 
 from .initialize import get_model_parallel_rank
 from .initialize import get_model_parallel_world_size
+from .initialize import get_model_parallel_group
+from .initialize import get_fp32_allreduce
 from .mappings import copy_to_model_parallel_region
 from .mappings import gather_from_model_parallel_region
 from .mappings import reduce_from_model_parallel_region
@@ -291,6 +293,8 @@ class ParallelRelativePositionBias(torch.nn.Module):
         self._q_len_cached = None
         self._k_len_cached = None
         self._rel_pos_bucket_cached = None
+        self._bias_cache_key = None
+        self._bias_cached = None
 
     def mup_reinitialize_weights(self, neox_args):
         if self.use_cpu_initialization:
@@ -365,6 +369,14 @@ class ParallelRelativePositionBias(torch.nn.Module):
             )
         else:
             rp_bucket = self._rel_pos_bucket_cached
+
+        # this module is shared by all layers, so without autograd (eval / generation) the bias is computed by
+        # the first layer and reused by the rest. In training every layer builds its own, so that
+        # gradients stay correct under activation checkpointing.
+        if not torch.is_grad_enabled():
+            cache_key = (q_len, k_len, self.weight._version)
+            if self._bias_cache_key == cache_key:
+                return self._bias_cached
         values = F.embedding(
             rp_bucket,
             self.weight,
@@ -374,8 +386,51 @@ class ParallelRelativePositionBias(torch.nn.Module):
             self.scale_grad_by_freq,
             self.sparse,
         )
-        bias = values.movedim(2, 0).unsqueeze(0)
-        return bias * self.scale
+        bias = values.movedim(2, 0).unsqueeze(0) * self.scale
+        if not torch.is_grad_enabled():
+            self._bias_cache_key, self._bias_cached = cache_key, bias
+        else:
+            self._bias_cache_key, self._bias_cached = None, None
+        return bias
+
+
+class _LinearWithAsyncAllreduce(torch.autograd.Function):
+    """
+    Linear layer whose input gradient is all-reduced across the model parallel group asynchronously in the
+    backward pass, so the communication overlaps with the weight gradient computation.
+    Equivalent to F.linear(copy_to_model_parallel_region(input_), weight, bias).
+    """
+
+    @staticmethod
+    def forward(ctx, input_, weight, bias):
+        ctx.save_for_backward(input_, weight)
+        ctx.use_bias = bias is not None
+        return F.linear(input_, weight, bias)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input_, weight = ctx.saved_tensors
+        grad_input = grad_output.matmul(weight)
+
+        # Bf16 convert
+        dt = grad_input.dtype
+        if dt == torch.bfloat16 and get_fp32_allreduce():
+            grad_input = grad_input.float()
+
+        # launch the all-reduce, then compute the weight gradient while it is in flight
+        handle = torch.distributed.all_reduce(
+            grad_input, group=get_model_parallel_group(), async_op=True
+        )
+        grad_output = grad_output.reshape(-1, grad_output.shape[-1])
+        grad_weight = grad_output.t().matmul(input_.reshape(-1, input_.shape[-1]))
+        grad_bias = grad_output.sum(dim=0) if ctx.use_bias else None
+        handle.wait()
+
+        # Bf16 convert
+        if dt == torch.bfloat16 and get_fp32_allreduce():
+            grad_input = grad_input.bfloat16()
+
+        return grad_input, grad_weight, grad_bias
 
 
 class ColumnParallelLinear(torch.nn.Module):
@@ -429,6 +484,7 @@ class ColumnParallelLinear(torch.nn.Module):
         self.stride = stride
         self.mup_rescale_parameters = mup_rescale_parameters
         self.use_mup = neox_args.use_mup
+        self.tp_allreduce_overlap = neox_args.tp_allreduce_overlap and world_size > 1
 
         # Parameters.
         # Note: torch.nn.functional.linear performs XA^T + b and as a result
@@ -549,12 +605,15 @@ class ColumnParallelLinear(torch.nn.Module):
     def forward(self, input_):
         if self.use_mup and self.mup_rescale_parameters:
             input_ /= self.width_mult()
-        # Set up backprop all-reduce.
-        input_parallel = copy_to_model_parallel_region(input_)
-        # Matrix multiply.
-
         bias = self.bias if not self.skip_bias_add else None
-        output_parallel = F.linear(input_parallel, self.weight, bias)
+        if self.tp_allreduce_overlap:
+            # Matrix multiply, backprop all-reduce is overlapped with the weight grad computation.
+            output_parallel = _LinearWithAsyncAllreduce.apply(input_, self.weight, bias)
+        else:
+            # Set up backprop all-reduce.
+            input_parallel = copy_to_model_parallel_region(input_)
+            # Matrix multiply.
+            output_parallel = F.linear(input_parallel, self.weight, bias)
         if self.gather_output:
             # All-gather across the partitions.
             output = gather_from_model_parallel_region(output_parallel)
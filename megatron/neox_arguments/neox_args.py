@@ -36,6 +36,7 @@ ATTENTION_TYPE_CHOICES = [
     "gmlp",
     "amlp",
     "flash",
+    "sdpa",
 ]
 
 
@@ -68,8 +69,9 @@ class NeoXArgsParallelism(NeoXArgsTemplate):
     pipe_partition_method: str = "type:transformer|mlp"
     """
     method used to distribute model layers across pipeline stages. Choose from "parameters", which balances the number
-    of parameters on each pipeline stage, "uniform", which naively balances the number of layers per stage, or
-    "type:[regex]", which balances layers whose class names match [regex]
+    of parameters on each pipeline stage, "uniform", which naively balances the number of layers per stage,
+    "type:[regex]", which balances layers whose class names match [regex], or "moe_aware", which balances an
+    estimated per-layer cost where MoE layers count once per expert
     """
 
     world_size: int = None
@@ -83,6 +85,12 @@ class NeoXArgsParallelism(NeoXArgsTemplate):
     according to pipeline parallel size.
     """
 
+    tp_allreduce_overlap: bool = False
+    """
+    If true, the backward all-reduce of the input gradient of column parallel linear layers is issued asynchronously
+    and overlapped with the weight gradient computation. Only has an effect when model_parallel_size > 1.
+    """
+
 
 @dataclass
 class NeoXArgsModel(NeoXArgsTemplate):
@@ -185,7 +193,10 @@ class NeoXArgsModel(NeoXArgsTemplate):
     The first item in the list specifies the attention type(s), and should be a list of strings. The second item
     specifies the number of times to repeat those attention types in the full list.
 
-    attention type choices:  [global, local, sparse_fixed, sparse_variable, bslongformer, bigbird]
+    attention type choices:  [global, local, sparse_fixed, sparse_variable, bslongformer, bigbird, flash, sdpa]
+
+    `sdpa` uses torch's F.scaled_dot_product_attention with a causal mask applied inside the kernel, so the
+    full attention mask / scores are never materialized. It does not support rpe / alibi or kv caching.
 
     So a 12 layer network with only global attention could be specified like:
         [[[`global`], 12]]
@@ -435,6 +446,12 @@ class NeoXArgsModel(NeoXArgsTemplate):
 
     moe_drop_tokens: bool = True
 
+    moe_a2a_num_chunks: int = 1
+    """
+    Split the tokens dispatched to the experts into this many chunks along the capacity dim, so that the all-to-all of
+    one chunk overlaps with the expert computation of another. 1 disables the overlap. Also applies to hier_moe.
+    """
+
 @dataclass
 class NeoXArgsOptimizer(NeoXArgsTemplate):
     """
@@ -64,17 +64,24 @@ def report_memory(name):
     print_rank_0(string)
 
 
+_attn_mask_cache = {}
+
+
 def get_attn_mask(seq_length, device):
     """
     Get triangular attention mask for a given sequence length / device.
+    The mask is built once per (seq_length, device) and the same tensor is returned afterwards, so it must not be
+    modified in place.
     """
-    # lower triangular attention mask
-    mask = torch.tril(torch.ones((1, seq_length, seq_length), device=device)).view(
-        1, 1, seq_length, seq_length
-    )
-
-    # convert to binary
-    return mask < 0.5
+    key = (seq_length, str(device))
+    mask = _attn_mask_cache.get(key)
+    if mask is None:
+        # True above the diagonal, i.e. where attention is masked out
+        mask = torch.ones(
+            (seq_length, seq_length), dtype=torch.bool, device=device
+        ).triu_(1).view(1, 1, seq_length, seq_length)
+        _attn_mask_cache[key] = mask
+    return mask
 
 
 def get_ltor_masks_and_position_ids(
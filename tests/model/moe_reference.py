@@ -0,0 +1,59 @@
+# Copyright (c) 2021, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+sizes and reference GShard gating shared by the MoE dispatch / combine tests
+"""
+
+import torch
+import torch.nn.functional as F
+
+NUM_TOKENS = 12
+NUM_EXPERTS = 3
+# fewer slots than routings, so tokens get dropped
+CAPACITY = 3
+D_MODEL = 8
+
+
+def gshard_gate(logits, k, gate_st=False, normalize=False):
+    """
+    (s, e, c) combine weights and dispatch mask built like the top-1 / top-2 gatings: the r-th choice of every
+    token takes the next free slot of its expert, or is dropped when the expert is full. Also returns the routing
+    probs and top-k norm, as the gatings do with return_gates=True. With normalize, the top-k (k > 1) combine
+    weights are divided by the top-k norm.
+    """
+    gates = torch.softmax(logits, dim=-1)
+    indices = gates.topk(k, dim=-1).indices
+    masks, locations = [], []
+    used_slots = torch.zeros(NUM_EXPERTS, dtype=torch.long)
+    for r in range(k):
+        mask = F.one_hot(indices[:, r], NUM_EXPERTS)
+        locations_se = torch.cumsum(mask, dim=0) - 1 + used_slots
+        used_slots = used_slots + mask.sum(dim=0)
+        mask = mask * torch.lt(locations_se, CAPACITY)
+        masks.append(mask)
+        locations.append(torch.sum(locations_se * mask, dim=1))
+    gates_s = [torch.sum(gates * mask, dim=-1) for mask in masks]
+    topk_norm = sum(gates_s).detach()
+    if normalize and k > 1:
+        topk_norm = torch.clamp(topk_norm, min=torch.finfo(topk_norm.dtype).eps)
+        gates_s = [g / topk_norm for g in gates_s]
+    combine_weights = sum(
+        torch.einsum("s,se,sc->sec", g, mask.type_as(g), F.one_hot(loc, CAPACITY).type_as(g))
+        for g, mask, loc in zip(gates_s, masks, locations)
+    )
+    dispatch_mask = combine_weights.bool()
+    if gate_st:
+        combine_weights = combine_weights - combine_weights.detach() + dispatch_mask
+    return combine_weights, dispatch_mask, gates, topk_norm
@@ -0,0 +1,111 @@
+# Copyright (c) 2021, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+check the layer weights and stage boundaries of the "moe_aware" pipe_partition_method
+"""
+from types import SimpleNamespace
+
+import pytest
+
+HIDDEN_SIZE = 8
+NUM_EXPERTS = 4
+VOCAB_SIZE = 16
+
+
+def get_model_stub(num_stages=2, stage_id=0):
+    """
+    the parts of GPT2ModelPipe that the partitioning reads, so no model (or process group) has to be built:
+    embedding, 2 MoE layers, 4 dense layers, final norm and output layer
+    """
+    from deepspeed.pipe import LayerSpec, TiedLayerSpec
+    from megatron.model.gpt2_model import (
+        GPT2ModelPipe,
+        _pre_transformer_block,
+        _post_transformer_block,
+    )
+    from megatron.model.moe_transformer import MoEParallelTransformerLayerPipe
+    from megatron.model.transformer import (
+        ParallelTransformerLayerPipe,
+        NormPipe,
+        ParallelLinearPipe,
+    )
+    from megatron.model.word_embeddings import EmbeddingPipe
+
+    model = SimpleNamespace(
+        neox_args=SimpleNamespace(
+            hidden_size=HIDDEN_SIZE,
+            moe_num_experts=NUM_EXPERTS,
+            padded_vocab_size=VOCAB_SIZE,
+        ),
+        _layer_specs=[
+            TiedLayerSpec("embed", EmbeddingPipe),
+            _pre_transformer_block,
+            LayerSpec(MoEParallelTransformerLayerPipe),
+            LayerSpec(MoEParallelTransformerLayerPipe),
+            LayerSpec(ParallelTransformerLayerPipe),
+            LayerSpec(ParallelTransformerLayerPipe),
+            LayerSpec(ParallelTransformerLayerPipe),
+            LayerSpec(ParallelTransformerLayerPipe),
+            _post_transformer_block,
+            LayerSpec(NormPipe),
+            LayerSpec(ParallelLinearPipe),
+        ],
+        _topo=SimpleNamespace(
+            get_dim=lambda axis: num_stages,
+            get_coord=lambda rank: SimpleNamespace(pipe=stage_id),
+        ),
+        global_rank=0,
+    )
+    model._layer_partition_weights = lambda: GPT2ModelPipe._layer_partition_weights(model)
+    model._set_bounds = lambda start, stop: setattr(model, "bounds", (start, stop))
+    return model, GPT2ModelPipe
+
+
+@pytest.mark.cpu
+def test_moe_aware_layer_weights():
+    """
+    MoE layers are weighted by their number of experts, helper functions and norms weigh nothing
+    """
+    model, GPT2ModelPipe = get_model_stub()
+    dense = 12 * HIDDEN_SIZE**2
+    moe = 4 * HIDDEN_SIZE**2 + 8 * HIDDEN_SIZE**2 * NUM_EXPERTS
+    vocab = VOCAB_SIZE * HIDDEN_SIZE
+    assert GPT2ModelPipe._layer_partition_weights(model) == [
+        vocab, 0, moe, moe, dense, dense, dense, dense, 0, 0, vocab
+    ]
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("stage_id", [0, 1])
+def test_moe_aware_stage_bounds(stage_id):
+    """
+    the two stages split the layers where the heavier stage is as light as possible
+    """
+    model, GPT2ModelPipe = get_model_stub(num_stages=2, stage_id=stage_id)
+    GPT2ModelPipe._partition_layers(model, method="moe_aware")
+
+    weights = GPT2ModelPipe._layer_partition_weights(model)
+    num_layers = len(weights)
+    assert model.parts[0] == 0 and model.parts[-1] == num_layers
+    assert model.bounds == (model.parts[stage_id], model.parts[stage_id + 1])
+
+    split = model.parts[1]
+    bottleneck = max(sum(weights[:split]), sum(weights[split:]))
+    best = min(
+        max(sum(weights[:i]), sum(weights[i:])) for i in range(num_layers + 1)
+    )
+    assert bottleneck == best
+    # the first stage gets the embedding and the two MoE layers, a uniform split would add a dense layer to it
+    assert split == 4
@@ -0,0 +1,126 @@
+# Copyright (c) 2021, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+check that the MoE pipeline output (lm output, aux losses, metadata) reaches the loss with activation checkpointing,
+which unpacks the args between layers
+"""
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from ..common import distributed_test
+
+HIDDEN_SIZE = 8
+VOCAB_SIZE = 16
+SEQ_LENGTH = 5
+BATCH_SIZE = 2
+NUM_MOE_LAYERS = 2
+
+
+def build_tail(weight_tying, activation_checkpoint_interval):
+    """
+    the layers of GPT2ModelPipe.to_sequential() after the transformer layers: the MoE post block, the final norm
+    and the output layer (tied to a stub embedding, or a ParallelLinearPipe), and all their parameters
+    """
+    from deepspeed.pipe import TiedLayerSpec
+    from megatron.model.gpt2_model import GPT2ModelPipe
+    from megatron.model.utils import Lambda, SequentialWrapper
+
+    neox_args = SimpleNamespace(
+        no_weight_tying=not weight_tying,
+        hidden_size=HIDDEN_SIZE,
+        padded_vocab_size=VOCAB_SIZE,
+        max_position_embeddings=SEQ_LENGTH,
+        hidden_dropout=0.0,
+        pos_emb="none",
+        moe_freq=1,
+        norm="layernorm",
+        layernorm_epsilon=1e-5,
+        output_layer_parallelism="column",
+        use_mup=False,
+        tp_allreduce_overlap=False,
+        use_cpu_initialization=True,
+        params_dtype=torch.float32,
+    )
+    model = SimpleNamespace(
+        neox_args=neox_args,
+        hidden_size=HIDDEN_SIZE,
+        num_tokentypes=0,
+        parallel_output=True,
+        init_method=torch.nn.init.xavier_normal_,
+        _build_layer_plan=lambda rpe_emb=None: [],
+    )
+    GPT2ModelPipe.init_specs(model)
+
+    torch.manual_seed(1234)
+    post_block, norm_spec, output_spec = model.specs[-3:]
+    layers = [Lambda(post_block), norm_spec.build(log=False)]
+    tied_parameters = []
+    if isinstance(output_spec, TiedLayerSpec):
+        embedding = SimpleNamespace(
+            word_embeddings_weight=torch.nn.Parameter(torch.randn(VOCAB_SIZE, HIDDEN_SIZE))
+        )
+        tied_parameters.append(embedding.word_embeddings_weight)
+        layers.append(Lambda(partial(output_spec.forward_fn, embedding)))
+    else:
+        layers.append(output_spec.build(log=False))
+    # without a parent class name every layer with parameters is checkpointed, so the norm and output layer are too
+    tail = SequentialWrapper(
+        layers,
+        activation_checkpoint_interval,
+        partial(torch.utils.checkpoint.checkpoint, use_reentrant=False),
+    )
+    return tail, list(tail.parameters()) + tied_parameters
+
+
+def run_tail(weight_tying, activation_checkpoint_interval):
+    """the loss and gradients (hidden states, aux losses, parameters) of the tail on fixed inputs"""
+    from megatron.model.criterion import get_criterion
+
+    tail, parameters = build_tail(weight_tying, activation_checkpoint_interval)
+    torch.manual_seed(0)
+    hidden_states = torch.randn(SEQ_LENGTH, BATCH_SIZE, HIDDEN_SIZE, requires_grad=True)
+    attention_mask = torch.ones(1, 1, SEQ_LENGTH, SEQ_LENGTH, dtype=torch.bool)
+    l_auxs = torch.rand(NUM_MOE_LAYERS, requires_grad=True)
+    metadata = [{} for _ in range(NUM_MOE_LAYERS)]
+    labels = torch.randint(VOCAB_SIZE, (BATCH_SIZE, SEQ_LENGTH))
+    loss_mask = torch.ones(BATCH_SIZE, SEQ_LENGTH)
+
+    outputs = tail((hidden_states, attention_mask, l_auxs, metadata))
+    loss = get_criterion(True).forward(outputs, (labels, loss_mask))
+    loss.backward()
+    return [loss, hidden_states.grad, l_auxs.grad] + [p.grad for p in parameters]
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("weight_tying", [True, False], ids=["tied", "untied"])
+def test_moe_pipe_output_with_activation_checkpointing(weight_tying):
+    @distributed_test(world_size=1, backend="gloo")
+    def wrapper():
+        from megatron import mpu
+
+        mpu.destroy_model_parallel()
+        mpu.initialize_model_parallel(1)
+
+        # interval 0 runs the layers on the args as they are, interval 1 unpacks them between layers
+        expected = run_tail(weight_tying, activation_checkpoint_interval=0)
+        actual = run_tail(weight_tying, activation_checkpoint_interval=1)
+        assert len(actual) == len(expected)
+        for a, e in zip(actual, expected):
+            torch.testing.assert_close(a, e)
+
+    wrapper()
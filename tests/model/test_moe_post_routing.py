@@ -0,0 +1,173 @@
+# Copyright (c) 2021, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+compare the post-routing MoE layers against their previous einsum / boolean-mask implementation
+"""
+
+import copy
+
+import pytest
+import torch
+
+from .moe_reference import NUM_TOKENS, NUM_EXPERTS, D_MODEL, gshard_gate
+
+
+class StubGate(torch.nn.Module):
+    def __init__(self, k):
+        super().__init__()
+        self.k = k
+        self.wg = torch.nn.Linear(D_MODEL, NUM_EXPERTS, bias=False, dtype=torch.float64)
+
+    def forward(self, inputs, used_token=None, return_gates=False):
+        combine_weights, dispatch_mask, routing_probs, topk_norm = gshard_gate(
+            self.wg(inputs), self.k, normalize=True
+        )
+        assert (~dispatch_mask.any(-1).any(-1)).any(), "the test needs dropped tokens"
+        l_aux = torch.zeros((), dtype=inputs.dtype)
+        if return_gates:
+            return l_aux, combine_weights, dispatch_mask, {}, routing_probs, topk_norm
+        return l_aux, combine_weights, dispatch_mask, {}
+
+
+class StubExperts(torch.nn.Module):
+    """identical local experts, applied to (g, e, c, m) dispatched tokens or to (s, m) tokens"""
+
+    def __init__(self):
+        super().__init__()
+        expert = torch.nn.Linear(D_MODEL, D_MODEL, dtype=torch.float64)
+        self.deepspeed_experts = torch.nn.ModuleList(
+            [copy.deepcopy(expert) for _ in range(NUM_EXPERTS)]
+        )
+
+    @property
+    def experts(self):
+        return self.deepspeed_experts
+
+    def forward(self, inputs):
+        if inputs.dim() == 2:
+            return self.deepspeed_experts[0](inputs)
+        chunks = inputs.chunk(NUM_EXPERTS, dim=1)
+        return torch.cat([e(c) for e, c in zip(self.deepspeed_experts, chunks)], dim=1)
+
+
+class IdentityAllToAll:
+    """the all-to-all over an expert-parallel group of one rank"""
+
+    @staticmethod
+    def apply(group, inputs):
+        return inputs
+
+
+def moefication_reference(layer, *inputs):
+    """LocalPostMoELayer.forward of moefication.py before the slot-index dispatch / combine"""
+    d_model = inputs[0].shape[-1]
+    reshaped_inputs = inputs[0].reshape(-1, d_model)
+    _, combine_weights, dispatch_mask, _, routing_probs, topk_norm = layer.gate(
+        reshaped_inputs, inputs[1], return_gates=True)
+    dispatched_inputs = torch.einsum("sec,sm->ecm", dispatch_mask.type_as(inputs[0]), reshaped_inputs)
+    dispatched_inputs = dispatched_inputs.reshape(layer.ep_size, layer.num_local_experts, -1, d_model)
+    expert_output = layer.experts(dispatched_inputs)
+    expert_output = expert_output.reshape(layer.ep_size * layer.num_local_experts, -1, d_model)
+
+    unrouted_type = layer.unrouted_type
+    if layer.gate.k == 1:
+        combine_weights = combine_weights - combine_weights.detach() + dispatch_mask
+        unrouted_type = 'all'
+    combined_output = torch.einsum("sec,ecm->sm", combine_weights.type_as(inputs[0]), expert_output)
+
+    combine_weights_sum = dispatch_mask.sum(dim=-1).sum(dim=-1)
+    if unrouted_type == 'all':
+        routed_mask = (combine_weights_sum != 0)
+    elif unrouted_type == 'any':
+        routed_mask = (combine_weights_sum == layer.gate.k)
+    elif unrouted_type == 'ignore_kth':
+        routed_mask = (combine_weights_sum >= layer.gate.k - 1)
+    unrouted_mask = ~routed_mask
+
+    masked_routing_probs = routing_probs[unrouted_mask].type_as(combined_output)
+    post_routing_outputs, post_routing_probs = layer.post_routing(reshaped_inputs[unrouted_mask], masked_routing_probs)
+    topk_norm = topk_norm[unrouted_mask].unsqueeze(dim=-1).type_as(combined_output)
+    local_scale = (layer.gate.k - combine_weights_sum[unrouted_mask].unsqueeze(dim=-1)).detach().type_as(combined_output)
+    local_norm = (post_routing_probs * local_scale).detach()
+    new_norm = torch.clamp(topk_norm + local_norm, min=torch.finfo(combine_weights.dtype).eps)
+    combined_output[unrouted_mask] = (
+        post_routing_outputs * post_routing_probs * local_scale
+        + topk_norm * combined_output[unrouted_mask]) / new_norm
+    return combined_output.reshape(inputs[0].shape)
+
+
+def local_post_moe_reference(layer, *inputs):
+    """LocalPostMoELayer.forward of local_post_moe.py before the slot-index dispatch / combine"""
+    d_model = inputs[0].shape[-1]
+    reshaped_inputs = inputs[0].reshape(-1, d_model)
+    _, combine_weights, dispatch_mask, _ = layer.gate(reshaped_inputs, inputs[1])
+    dispatched_inputs = torch.einsum("sec,sm->ecm", dispatch_mask.type_as(inputs[0]), reshaped_inputs)
+    dispatched_inputs = dispatched_inputs.reshape(layer.ep_size, layer.num_local_experts, -1, d_model)
+    expert_output = layer.experts(dispatched_inputs)
+    expert_output = expert_output.reshape(layer.ep_size * layer.num_local_experts, -1, d_model)
+    if layer.gate.k == 1:
+        combine_weights = combine_weights - combine_weights.detach() + dispatch_mask
+    combined_output = torch.einsum("sec,ecm->sm", combine_weights.type_as(inputs[0]), expert_output)
+    routed_mask = (dispatch_mask != 0).any(-1).any(-1)
+    dense_outputs = layer.experts(reshaped_inputs)
+    combined_output[~routed_mask] = dense_outputs[~routed_mask]
+    return combined_output.reshape(inputs[0].shape)
+
+
+def run_layer(layer_cls, k, forward_fn, **kwargs):
+    """output and gradients (input, gate, experts) of `forward_fn(layer, tokens, used_token)` on a fresh layer"""
+    torch.manual_seed(0)
+    layer = layer_cls(StubGate(k), StubExperts(), "ep_size_1", 1, NUM_EXPERTS, **kwargs)
+    # a single expert-parallel rank, so post_routing needs no process group
+    layer.ep_rank, layer.ep_world_size = 0, 1
+    tokens = torch.randn(NUM_TOKENS // 2, 2, D_MODEL, dtype=torch.float64, requires_grad=True)
+    output = forward_fn(layer, tokens, None)
+    output.backward(torch.randn_like(output))
+    return [output, tokens.grad] + [
+        p.grad if p.grad is not None else torch.zeros_like(p) for p in layer.parameters()
+    ]
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize(
+    "k,unrouted_type", [(1, "all"), (2, "all"), (2, "any"), (2, "ignore_kth")]
+)
+def test_moefication_post_routing_matches_boolean_mask(monkeypatch, k, unrouted_type):
+    from megatron.model.moe import moefication
+    from megatron.model.moe.moefication import LocalPostMoELayer
+
+    monkeypatch.setattr(moefication, "_AllToAll", IdentityAllToAll)
+    expected = run_layer(LocalPostMoELayer, k, moefication_reference, unrouted_type=unrouted_type)
+    actual = run_layer(
+        LocalPostMoELayer, k, lambda layer, *inputs: layer(*inputs), unrouted_type=unrouted_type
+    )
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        torch.testing.assert_close(a, e)
+
+
+@pytest.mark.cpu
+def test_local_post_moe_matches_boolean_mask(monkeypatch):
+    from megatron.model.moe import local_post_moe
+    from megatron.model.moe.local_post_moe import LocalPostMoELayer
+
+    monkeypatch.setattr(local_post_moe, "_AllToAll", IdentityAllToAll)
+    # top-1 only: LocalPostMoELayer checks that routed tokens match the dense experts, which needs
+    # straight-through combine weights
+    expected = run_layer(LocalPostMoELayer, 1, local_post_moe_reference)
+    actual = run_layer(LocalPostMoELayer, 1, lambda layer, *inputs: layer(*inputs))
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        torch.testing.assert_close(a, e)
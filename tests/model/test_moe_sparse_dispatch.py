@@ -0,0 +1,60 @@
+# Copyright (c) 2021, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+compare the slot-index MoE dispatch / combine against the GShard einsums they replace
+"""
+
+import pytest
+import torch
+
+from .moe_reference import NUM_TOKENS, NUM_EXPERTS, CAPACITY, D_MODEL, gshard_gate
+
+
+def run_moe(k, gate_st, sparse):
+    from megatron.model.moe.baselayer import topk_slots, sparse_dispatch, sparse_combine
+
+    torch.manual_seed(0)
+    logits = torch.randn(NUM_TOKENS, NUM_EXPERTS, dtype=torch.float64, requires_grad=True)
+    reshaped_input = torch.randn(NUM_TOKENS, D_MODEL, dtype=torch.float64, requires_grad=True)
+    weight = torch.randn(D_MODEL, D_MODEL, dtype=torch.float64, requires_grad=True)
+    expert_fn = lambda dispatched: torch.tanh(dispatched @ weight)
+
+    combine_weights, dispatch_mask, _, _ = gshard_gate(logits, k, gate_st)
+    assert (~dispatch_mask.any(-1).any(-1)).any(), "the test needs dropped tokens"
+    if sparse:
+        slots, kept = topk_slots(combine_weights, dispatch_mask, k)
+        dispatched_input = sparse_dispatch(reshaped_input, slots, kept, NUM_EXPERTS, CAPACITY)
+        output = sparse_combine(expert_fn(dispatched_input), slots, combine_weights)
+    else:
+        dispatched_input = torch.einsum(
+            "sec,sm->ecm", dispatch_mask.type_as(reshaped_input), reshaped_input
+        )
+        output = torch.einsum("sec,ecm->sm", combine_weights, expert_fn(dispatched_input))
+
+    output.backward(torch.randn_like(output))
+    return output, dispatched_input, logits.grad, reshaped_input.grad, weight.grad
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize(
+    "k,gate_st", [(1, False), (1, True), (2, False)], ids=["top1", "top1_gate_st", "top2"]
+)
+def test_sparse_dispatch_combine_matches_einsum(k, gate_st):
+    expected = run_moe(k, gate_st, sparse=False)
+    actual = run_moe(k, gate_st, sparse=True)
+    for name, a, e in zip(
+        ["output", "dispatched_input", "logits.grad", "input.grad", "weight.grad"], actual, expected
+    ):
+        torch.testing.assert_close(a, e, msg=lambda m: f"{name}: {m}")
@@ -0,0 +1,86 @@
+# Copyright (c) 2021, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+compare the overlapped (chunked, async) MoE all-to-all against deepspeed's blocking _AllToAll
+"""
+
+import pytest
+import torch
+
+from ..common import distributed_test
+
+
+def blocking_reference(group, dispatched_input, expert_fn):
+    from deepspeed.moe.sharded_moe import _AllToAll
+
+    routed = _AllToAll.apply(group, dispatched_input)
+    return _AllToAll.apply(group, expert_fn(routed))
+
+
+@pytest.mark.parametrize("num_chunks", [1, 2, 3])
+def test_chunked_all_to_all(num_chunks):
+    @distributed_test(world_size=[1, 2])
+    def wrapper():
+        import torch.distributed as dist
+        from megatron.model.moe.overlap_moe import chunked_all_to_all
+
+        group = dist.group.WORLD
+        world_size = dist.get_world_size()
+        torch.manual_seed(1234 + dist.get_rank())
+        # (e, c, m), 7 does not split evenly into the chunks
+        dispatched_input = torch.randn(2 * world_size, 7, 16, device="cuda")
+        weight = torch.randn(16, 16, device="cuda")
+        expert_fn = lambda x: torch.tanh(x @ weight)
+
+        expected_input = dispatched_input.clone().requires_grad_()
+        expected = blocking_reference(group, expected_input, expert_fn)
+        actual_input = dispatched_input.clone().requires_grad_()
+        actual = chunked_all_to_all(group, actual_input, expert_fn, num_chunks)
+        torch.testing.assert_close(actual, expected)
+
+        grad_output = torch.randn_like(expected)
+        expected.backward(grad_output)
+        actual.backward(grad_output)
+        torch.testing.assert_close(actual_input.grad, expected_input.grad)
+
+    wrapper()
+
+
+def test_async_all_to_all():
+    @distributed_test(world_size=[1, 2])
+    def wrapper():
+        import torch.distributed as dist
+        from deepspeed.moe.sharded_moe import _AllToAll
+        from megatron.model.moe.overlap_moe import AsyncAllToAll
+
+        group = dist.group.WORLD
+        torch.manual_seed(1234 + dist.get_rank())
+        inputs = torch.randn(2 * dist.get_world_size(), 5, 8, device="cuda")
+
+        expected_input = inputs.clone().requires_grad_()
+        expected = _AllToAll.apply(group, expected_input)
+        actual_input = inputs.clone().requires_grad_()
+        handles = []
+        actual = AsyncAllToAll.apply(group, actual_input, handles)
+        assert len(handles) == 1
+        handles[0].wait()
+        torch.testing.assert_close(actual, expected)
+
+        grad_output = torch.randn_like(expected)
+        expected.backward(grad_output)
+        actual.backward(grad_output)
+        torch.testing.assert_close(actual_input.grad, expected_input.grad)
+
+    wrapper()
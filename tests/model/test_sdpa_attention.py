@@ -0,0 +1,115 @@
+# Copyright (c) 2021, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+compare the "sdpa" attention type against the default ("global") attention path
+"""
+
+from copy import deepcopy
+
+import pytest
+import torch
+
+from ..common import distributed_test, get_root_directory, BASE_CONFIG, binary
+
+
+def attention_setup(param_dict):
+    from megatron.neox_arguments import NeoXArgs
+    from megatron.mpu import destroy_model_parallel
+    from megatron import initialize_megatron
+
+    destroy_model_parallel()
+    config = deepcopy(BASE_CONFIG)
+    config.update(
+        {
+            "user_script": str(get_root_directory() / "train.py"),
+            "num_layers": 4,
+            "pos_emb": "none",
+            "fp16": {"enabled": False},
+            "attention_dropout": 0.0,
+        }
+    )
+    config.update(param_dict)
+    neox_args = NeoXArgs.from_dict(config)
+    initialize_megatron(neox_args=neox_args)
+    return neox_args
+
+
+def build_attention(neox_args, attention_type, layer_number, **kwargs):
+    from megatron.model.transformer import ParallelSelfAttention
+    from megatron.model.gpt2_model import gpt2_attention_mask_func
+    from megatron.model.init_functions import init_method_normal
+
+    neox_args.update_value("attention_config", [attention_type] * neox_args.num_layers)
+    init_method = init_method_normal(0.02)
+    return ParallelSelfAttention(
+        neox_args=neox_args,
+        attention_mask_func=gpt2_attention_mask_func,
+        init_method=init_method,
+        output_layer_init_method=init_method,
+        layer_number=layer_number,
+        **kwargs,
+    ).cuda()
+
+
+@pytest.mark.parametrize("apply_query_key_layer_scaling", binary)
+def test_sdpa_matches_global(apply_query_key_layer_scaling):
+    @distributed_test(world_size=1)
+    def wrapper():
+        from megatron.utils import get_attn_mask
+
+        neox_args = attention_setup(
+            {"apply_query_key_layer_scaling": apply_query_key_layer_scaling}
+        )
+        # layer 3 so that query-key layer scaling uses a coefficient > 1
+        reference = build_attention(neox_args, "global", layer_number=3).eval()
+        sdpa = build_attention(neox_args, "sdpa", layer_number=3).eval()
+        sdpa.load_state_dict(reference.state_dict())
+
+        seq_length, batch_size = 64, 2
+        hidden_states = torch.randn(
+            seq_length, batch_size, neox_args.hidden_size, device="cuda"
+        )
+        attention_mask = get_attn_mask(seq_length, hidden_states.device)
+        with torch.no_grad():
+            expected, _ = reference(hidden_states, attention_mask)
+            actual, _ = sdpa(hidden_states, attention_mask)
+        torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-5)
+
+    wrapper()
+
+
+@pytest.mark.parametrize("pos_emb", ["rpe", "alibi"])
+def test_sdpa_rejects_pos_emb(pos_emb):
+    @distributed_test(world_size=1)
+    def wrapper():
+        neox_args = attention_setup({"pos_emb": pos_emb})
+        with pytest.raises(AssertionError):
+            build_attention(neox_args, "sdpa", layer_number=0)
+
+    wrapper()
+
+
+def test_sdpa_rejects_kv_cache():
+    @distributed_test(world_size=1)
+    def wrapper():
+        from megatron.utils import get_attn_mask
+
+        neox_args = attention_setup({})
+        sdpa = build_attention(neox_args, "sdpa", layer_number=0, use_cache=True)
+        hidden_states = torch.randn(8, 1, neox_args.hidden_size, device="cuda")
+        with pytest.raises(AssertionError):
+            sdpa(hidden_states, get_attn_mask(8, hidden_states.device))
+
+    wrapper()
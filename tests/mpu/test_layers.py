@@ -0,0 +1,65 @@
+# Copyright (c) 2021, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+compare the model parallel linear with asynchronous input-gradient all-reduce against F.linear
+"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from ..common import distributed_test, binary
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("use_bias", binary)
+@pytest.mark.parametrize(
+    "dtype,fp32_allreduce",
+    [(torch.float32, False), (torch.bfloat16, False), (torch.bfloat16, True)],
+    ids=["fp32", "bf16", "bf16_fp32_allreduce"],
+)
+def test_linear_with_async_allreduce(use_bias, dtype, fp32_allreduce):
+    # a single model parallel rank on gloo checks the math, the all-reduce is the identity
+    @distributed_test(world_size=1, backend="gloo")
+    def wrapper():
+        from megatron import mpu
+        from megatron.mpu.layers import _LinearWithAsyncAllreduce
+
+        mpu.destroy_model_parallel()
+        mpu.initialize_model_parallel(1, fp32_allreduce=fp32_allreduce)
+
+        torch.manual_seed(1234)
+        # (s, b, h) input, like the transformer layers pass it
+        inputs = torch.randn(5, 2, 16, dtype=dtype)
+        weight = torch.randn(8, 16, dtype=dtype)
+        bias = torch.randn(8, dtype=dtype) if use_bias else None
+        grad_output = torch.randn(5, 2, 8, dtype=dtype)
+
+        def run(fn):
+            tensors = [t.clone().requires_grad_() for t in (inputs, weight, bias) if t is not None]
+            output = fn(*tensors, *([None] if bias is None else []))
+            output.backward(grad_output)
+            return [output] + [t.grad for t in tensors]
+
+        expected = run(
+            lambda x, w, b: F.linear(mpu.copy_to_model_parallel_region(x), w, b)
+        )
+        actual = run(_LinearWithAsyncAllreduce.apply)
+        assert len(actual) == len(expected)
+        for name, a, e in zip(["output", "input.grad", "weight.grad", "bias.grad"], actual, expected):
+            assert a.dtype == dtype
+            torch.testing.assert_close(a, e, msg=lambda m: f"{name}: {m}")
+
+    wrapper()